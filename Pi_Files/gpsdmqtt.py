@@ -3,6 +3,12 @@ import paho.mqtt.client as mqtt
 import time, gpsd, sys
 import wifi
 import datetime
+from gpscommon.sampler import AdaptiveSampler
+from gpscommon import geohash, dwell, topics
+
+DEV_ID = "gpsd_cgood"
+# the server shards devices over its workers by this per-device topic
+TOPIC = topics.device_topic("gpsd_location", DEV_ID)
 
 
 if __name__ == '__main__':
@@ -42,12 +48,15 @@ if __name__ == '__main__':
                     time.sleep(1)
 
             log.write("MQTT CONNECTED::: Sending test message\n")
-            client.publish(topic="gpsd_location", payload="{'error': 'Test publish, please ignore'}")
+            client.publish(topic=TOPIC, payload="{'error': 'Test publish, please ignore'}")
             log.write("CONNECTING GPSD::: Attempting to connect \n")
             client.loop_start()
             gpsd.connect()
             log.write("CONNECTING GPSD::: Connection successful. Starting Loop... \n\n")
             last_response = gpsd.get_current()
+            sampler = AdaptiveSampler()
+            detector = dwell.DwellDetector()
+            last_report = time.time()
 
             while True:
                 try:
@@ -56,17 +65,26 @@ if __name__ == '__main__':
                     dt = gpsdresp.get_time()
                     if last_response.lat == gpsdresp.lat and last_response.lon == gpsdresp.lon:
                         raise gpsd.NoFixError()
+                    last_response = gpsdresp
                     log.write("COLLECTED DATA::: gps location data\n")
 
-                    if gpsdresp.lat != 0.0 and gpsdresp.lon != 0.0:
+                    if devtime_epoch - last_report > 300:
+                        log.write("SAMPLER::: sent: " + str(sampler.sent) + ", suppressed: " + str(sampler.suppressed) + '\n')
+                        last_report = devtime_epoch
+
+                    if gpsdresp.lat == 0.0 or gpsdresp.lon == 0.0:
+                        log.write("WARNING::: GPS has no fix, can't send data\n")
+                    elif sampler.should_send(gpsdresp.lat, gpsdresp.lon, gpsdresp.hspeed, gpsdresp.track,
+                                             max(gpsdresp.error['x'], gpsdresp.error['y']), devtime_epoch):
                         payload = {"loc": {
                                        "lat": gpsdresp.lat,
                                        "lon": gpsdresp.lon
                                    },
                                    "meta.deviceepoch": devtime_epoch,
                                    "meta.type": "location",
-                                   "meta.devID": "gpsd_cgood",
+                                   "meta.devID": DEV_ID,
                                    "meta.weight": 0,
+                                   "meta.suppressed": sampler.take_suppressed(),
                                    "error.climb": gpsdresp.error['c'],
                                    "error.speed": gpsdresp.error['s'],
                                    "error.altitude": gpsdresp.error['v'],
@@ -83,11 +101,10 @@ if __name__ == '__main__':
                                    "time.hour": dt.hour,
                                    "time.minute": dt.minute,
                                    "time.second": dt.second}
+                        payload["pos.geohash_int"] = geohash.geohash_int(gpsdresp.lat, gpsdresp.lon, 40)
+                        payload["meta.dwell"] = detector.update(payload)
                         log.write('SENT GPS MESSAGE::: Time: ' + str(devtime_epoch) + '\n')
-                        client.publish(topic='gpsd_location', payload=str(payload))
-                        last_response = gpsdresp
-                    else:
-                        log.write("WARNING::: GPS has no fix, can't send data\n")
+                        client.publish(topic=TOPIC, payload=str(payload))
                     time.sleep(1)
                 except (gpsd.NoFixError, UserWarning):
                     try:
@@ -99,7 +116,7 @@ if __name__ == '__main__':
                             "wifiAccessPoints": wifiaccesspoints,
                             "meta.deviceepoch": devtime_epoch,
                             "meta.type": "wifilocation",
-                            "meta.devID": "gpsd_cgood",
+                            "meta.devID": DEV_ID,
                             "meta.weight": 0,
                             "time.timezone": "UTC",
                             "time.year": dt.year,
@@ -108,7 +125,7 @@ if __name__ == '__main__':
                             "time.hour": dt.hour,
                             "time.minute": dt.minute,
                             "time.second": dt.second}
-                        client.publish(topic='gpsd_location', payload=str(payload))
+                        client.publish(topic=TOPIC, payload=str(payload))
                         log.write('SENT WIFI MESSAGE::: Time: ' + str(devtime_epoch) + '\n')
                     except Exception as e:
                         log.write("ERROR::: error getting wifi data: " + str(sys.exc_info()))
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+import collections, math, queue, sys, threading, time
+from gpscommon import geohash, dwell
+
+
+class SpeedSketch:
+    """
+    Fixed-size histogram of speeds with logarithmic buckets, for approximate percentiles in constant memory.
+
+    Bucket i holds speeds in (min_speed * gamma^(i-1), min_speed * gamma^i], so any percentile it reports is within
+    a factor of gamma of the real one (5% with the default). Speeds at or below min_speed go in bucket 0.
+    """
+    def __init__(self, min_speed=0.1, max_speed=100, gamma=1.05):
+        self.min_speed = min_speed
+        self.log_gamma = math.log(gamma)
+        self.gamma = gamma
+        self.counts = [0] * (math.ceil(math.log(max_speed / min_speed) / self.log_gamma) + 2)
+        self.total = 0
+        self.max = 0
+
+    def add(self, speed):
+        if speed <= self.min_speed:
+            index = 0
+        else:
+            index = min(len(self.counts) - 1, math.ceil(math.log(speed / self.min_speed) / self.log_gamma) + 1)
+        self.counts[index] += 1
+        self.total += 1
+        self.max = max(self.max, speed)
+
+    def quantile(self, q) -> float:
+        """
+        :param q: between 0 and 1
+        :return: the approximate q-th quantile of the speeds added, or 0 if there are none
+        """
+        if self.total == 0:
+            return 0
+        rank = q * (self.total - 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen > rank:
+                if index == 0:
+                    return 0
+                return min(self.max, self.min_speed * self.gamma**(index - 0.5))
+        return self.max
+
+
+class TrackStats:
+    """
+    Running totals for one device over one UTC day. update() does a constant amount of work per fix.
+
+    Until resume() has been called with the summary stored by an earlier run of the server (or None), fixes are held
+    instead of counted, since it is not known yet which of them that summary already has. At most max_held are held;
+    past that, the oldest are counted straight away.
+    """
+    def __init__(self, dev_id, day, max_gap=600, top_places=20, max_held=600):
+        """
+        :param dev_id: the device
+        :param day: the UTC day the totals are for, as a number of days since the epoch
+        :param max_gap: time between two fixes above which the time in between is not counted, in seconds
+        :param top_places: number of dwell cells included in a summary
+        :param max_held: most fixes held until resume() is called
+        """
+        self.dev_id = dev_id
+        self.day = day
+        self.max_gap = max_gap
+        self.top_places = top_places
+        self.max_held = max_held
+        self.held = collections.deque()
+        self.fixes = 0
+        self.distance = 0
+        self.moving_seconds = 0
+        self.dwell_seconds = 0
+        self.dwells = 0
+        self.places = {}
+        self.speeds = SpeedSketch()
+        self.first_epoch = None
+        self.last = None
+        self.resumed = False
+        self.stored_epoch = None
+
+    def key(self) -> dict:
+        """
+        :return: the fields of a summary that say which device and day it is for, and where it is stored
+        """
+        date = time.gmtime(self.day * 86400)
+        year, month, day = date.tm_year, date.tm_mon, date.tm_mday
+        return {"meta.type": "summary",
+                "meta.devID": self.dev_id,
+                "meta.id": "%s-summary-%04d.%02d.%02d" % (self.dev_id, year, month, day),
+                "time.timezone": "UTC",
+                "time.year": year,
+                "time.month": month,
+                "time.day": day}
+
+    def resume(self, stored):
+        """
+        Adds the totals of a summary of this device and day uploaded before (by an earlier run of the server) to these,
+        then counts the fixes held until now. Fixes up to the last one it counted are not counted again. Only the
+        top_places dwell cells it listed are kept, and if more than max_held fixes had to be held, the ones counted
+        without it are not checked against it, and the step from its last fix to the first of them is not counted
+
+        :param stored: the summary document, or None if there is none
+        """
+        self.resumed = True
+        held, self.held = self.held, collections.deque()
+        if stored is not None:
+            self.add(stored)
+        for payload, kind in held:
+            self.count(payload, kind)
+
+    def add(self, stored):
+        self.fixes += stored["stats.fixes"]
+        self.distance += stored["stats.distance"]
+        self.moving_seconds += stored["stats.moving_seconds"]
+        self.dwell_seconds += stored["stats.dwell_seconds"]
+        self.dwells += stored["stats.dwells"]
+        for place in stored["stats.places"]:
+            self.places[place["geohash"]] = self.places.get(place["geohash"], 0) + place["dwells"]
+        counts = stored.get("stats.speed_counts", [])
+        if len(counts) == len(self.speeds.counts):
+            self.speeds.counts = [mine + theirs for mine, theirs in zip(self.speeds.counts, counts)]
+            self.speeds.total = sum(self.speeds.counts)
+        self.speeds.max = max(self.speeds.max, stored["stats.speed_max"])
+        first_epoch = stored["stats.first_epoch"]
+        self.first_epoch = first_epoch if self.first_epoch is None else min(self.first_epoch, first_epoch)
+        self.stored_epoch = stored["meta.deviceepoch"]
+        if self.last is None and "stats.last_lat" in stored:
+            self.last = (stored["stats.last_lat"], stored["stats.last_lon"], self.stored_epoch)
+
+    def update(self, payload, kind) -> bool:
+        """
+        :param payload: a location payload
+        :param kind: what the device's DwellDetector made of it
+        :return: False if the fix was already counted in the summary resumed from, True otherwise
+        """
+        if not self.resumed:
+            self.held.append((payload, kind))
+            if len(self.held) > self.max_held:
+                self.count(*self.held.popleft())
+            return True
+        return self.count(payload, kind)
+
+    def count(self, payload, kind) -> bool:
+        lat, lon, epoch = payload["loc"]["lat"], payload["loc"]["lon"], payload["meta.deviceepoch"]
+        if self.stored_epoch is not None and epoch <= self.stored_epoch:
+            return False
+        moving = kind in (dwell.MOVE, dwell.LEAVE)
+        self.fixes += 1
+        if self.first_epoch is None:
+            self.first_epoch = epoch
+        if self.last is not None:
+            last_lat, last_lon, last_epoch = self.last
+            gap = epoch - last_epoch
+            if 0 < gap <= self.max_gap:
+                if moving:
+                    self.moving_seconds += gap
+                else:
+                    self.dwell_seconds += gap
+            if moving:
+                self.distance += geohash.haversine(last_lat, last_lon, lat, lon)
+        if moving:
+            self.speeds.add(payload.get("pos.speed", 0))
+        if kind == dwell.DWELL:
+            self.dwells += 1
+            cell = dwell.cell(payload)
+            self.places[cell] = self.places.get(cell, 0) + 1
+        self.last = (lat, lon, epoch)
+        return True
+
+    def summary(self) -> dict:
+        """
+        :return: a summary document of the day so far. Its meta.id is the same for every summary of this device and
+        day, so uploading a newer one replaces the older one. The speed histogram and last position are included so
+        that the totals can be resumed from it (see resume())
+        """
+        places = sorted(self.places.items(), key=lambda item: item[1], reverse=True)[:self.top_places]
+        summary = self.key()
+        summary.update({
+            "meta.deviceepoch": self.last[2],
+            "stats.first_epoch": self.first_epoch,
+            "stats.fixes": self.fixes,
+            "stats.distance": self.distance,
+            "stats.moving_seconds": self.moving_seconds,
+            "stats.dwell_seconds": self.dwell_seconds,
+            "stats.dwells": self.dwells,
+            "stats.speed_p50": self.speeds.quantile(0.5),
+            "stats.speed_p90": self.speeds.quantile(0.9),
+            "stats.speed_p99": self.speeds.quantile(0.99),
+            "stats.speed_max": self.speeds.max,
+            "stats.speed_counts": list(self.speeds.counts),
+            "stats.last_lat": self.last[0],
+            "stats.last_lon": self.last[1],
+            "stats.places": [{"geohash": cell, "dwells": count} for cell, count in places]})
+        return summary
+
+
+class Aggregator:
+    """
+    Keeps a TrackStats per device for the current day, and puts their summaries on the upload queue every `interval`
+    seconds (for the devices that have had fixes since the last time), and when a device's day is over.
+
+    When a device's day is first seen, the key of the summary already stored for it (if the server was restarted during
+    the day) is put on load_queue, for a SummaryLoader to look up, and counting carries on from its totals once it is
+    back in `loaded`. So update() never waits on Elasticsearch. No summary of a device and day is uploaded before that,
+    so the stored one is never replaced with a partial one; a lookup that failed is asked for again at the next flush.
+    """
+    def __init__(self, upl_queue, interval=300, load_queue=None):
+        """
+        :param upl_queue: queue the summaries are put on
+        :param interval: time between summaries, in seconds
+        :param load_queue: queue for the keys of the stored summaries to look up. Without it, summaries are never
+        resumed
+        """
+        self.upl_queue = upl_queue
+        self.interval = interval
+        self.load_queue = load_queue
+        # (meta.id, whether the lookup worked, stored summary or None), put by the SummaryLoader
+        self.loaded = queue.Queue()
+        # TrackStats waiting for their stored summary, by meta.id, and those whose lookup failed
+        self.waiting = {}
+        self.failed = []
+        # TrackStats of days that are over, still waiting for their stored summary
+        self.finished = []
+        self.stats = {}
+        self.changed = set()
+        self.flushed = time.time()
+
+    def update(self, payload, kind):
+        """
+        Called by Memory.geocode() for every location fix
+        """
+        if self.waiting:
+            self.collect()
+        dev_id = payload["meta.devID"]
+        day = int(payload["meta.deviceepoch"] // 86400)
+        stats = self.stats.get(dev_id)
+        if stats is None or day > stats.day:
+            if stats is not None:
+                self.finish(stats)
+                self.changed.discard(dev_id)
+            stats = self.stats[dev_id] = TrackStats(dev_id, day)
+            self.request(stats)
+        # late fixes from a day that has already been summarised are not counted
+        if stats.day == day and stats.update(payload, kind):
+            self.changed.add(dev_id)
+        if time.time() - self.flushed > self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Puts a summary of every device with new fixes on the upload queue, except for those still waiting for their
+        stored summary, and asks again for the stored summaries that could not be looked up
+        """
+        self.collect()
+        changed, self.changed = self.changed, set()
+        self.flushed = time.time()
+        for dev_id in changed:
+            stats = self.stats[dev_id]
+            if stats.resumed:
+                self.put(stats)
+            else:
+                self.changed.add(dev_id)
+        finished, self.finished = self.finished, []
+        for stats in finished:
+            self.finish(stats)
+        failed, self.failed = self.failed, []
+        for stats in failed:
+            self.load_queue.put(stats.key())
+
+    def request(self, stats):
+        if self.load_queue is None:
+            stats.resume(None)
+            return
+        key = stats.key()
+        self.waiting[key["meta.id"]] = stats
+        self.load_queue.put(key)
+
+    def collect(self):
+        """
+        Resumes the TrackStats whose stored summaries the SummaryLoader has looked up
+        """
+        while True:
+            try:
+                meta_id, found, stored = self.loaded.get_nowait()
+            except queue.Empty:
+                return
+            stats = self.waiting.get(meta_id)
+            if stats is None:
+                continue
+            if found:
+                del self.waiting[meta_id]
+                stats.resume(stored)
+            else:
+                self.failed.append(stats)
+
+    def finish(self, stats):
+        if stats.resumed:
+            self.put(stats)
+        else:
+            self.finished.append(stats)
+
+    def put(self, stats):
+        # every fix held may have been in the stored summary already
+        if stats.last is not None:
+            self.upl_queue.put(stats.summary())
+
+
+class SummaryLoader(threading.Thread):
+    """
+    Separate thread of control that looks up the stored summaries an Aggregator asks for, so that the requests to
+    Elasticsearch are never made on the message path. After a lookup fails, the ones that follow in the next `RETRY`
+    seconds are failed without trying, so a backlog of them does not take one timeout each; the Aggregator asks for
+    failed ones again at its next flush.
+    """
+    RETRY = 30
+
+    def __init__(self, load_queue, loaded, load, log_queue):
+        """
+        :param load_queue: queue of the keys to look up (see TrackStats.key())
+        :param loaded: queue the results are put on, as (meta.id, whether the lookup worked, stored summary or None)
+        :param load: function taking a key and returning the summary stored under it, or None if there is none. It
+        raises an exception if it cannot tell
+        :param log_queue: queue to log failed lookups to
+        """
+        threading.Thread.__init__(self, name="SummaryLoader")
+        self.__stop = False
+        self.load_queue = load_queue
+        self.loaded = loaded
+        self.load = load
+        self.log_queue = log_queue
+        self.failed = 0
+        self.daemon = True
+
+    def run(self):
+        while 1:
+            try:
+                if self.__stop:
+                    return 0
+                try:
+                    key = self.load_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if time.time() - self.failed < self.RETRY:
+                    self.loaded.put((key["meta.id"], False, None))
+                    continue
+                try:
+                    self.loaded.put((key["meta.id"], True, self.load(key)))
+                except Exception:
+                    self.failed = time.time()
+                    self.loaded.put((key["meta.id"], False, None))
+                    self.log_queue.put(("SummaryLoader", "Error: could not load the stored summary " + key["meta.id"] +
+                                        ": " + str(sys.exc_info()) + "\n"))
+            except:
+                self.log_queue.put(("SummaryLoader", "Error: " + str(sys.exc_info()) + "\n"))
+
+    def stop_thread(self):
+        """
+        Should not be called unless self.queue is empty
+        :return: None
+        """
+        self.__stop = True
@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+import argparse, array, bisect, itertools, json, mmap, os, sys, time
+from gpscommon import geohash
+
+"""Columnar archive of the location history, for keeping it cheaply outside of Elasticsearch.
+
+The archive is a directory tree with one partition per device per UTC day:
+
+    <root>/<devID>/<YYYY-MM-DD>/
+        meta.json       row count, first epoch, and the dictionaries for the encoded string columns
+        geohash.u64     geohash_int() of loc at 64 bits, so the column sorts and range-searches like a geohash
+        epoch.i32       meta.deviceepoch in milliseconds, each row stored as the difference from the row before
+        speed.f32, track.f32, alt.f32, error.f32, weight.f32
+        type.u8         meta.type, dictionary encoded
+        geo.<name>.u16  each geo.* field, dictionary encoded, 0 meaning the row has no value
+
+Rows in a partition are sorted by time. Every column file is a flat array of native-endian numbers, so a reader can
+mmap it and use it in place without parsing anything.
+
+Examples:
+    # export October from Elasticsearch
+    python3 archive.py export --root /data/archive --start 1790812800 --end 1793491200
+
+    # export a file written by fleetgen.py
+    python3 archive.py export --root /tmp/archive --input fixes.txt
+"""
+
+FLOAT_COLUMNS = (('speed', 'pos.speed'), ('track', 'pos.track'), ('alt', 'pos.alt'), ('weight', 'meta.weight'))
+TYPECODES = {'u64': 'Q', 'i32': 'i', 'f32': 'f', 'u8': 'B', 'u16': 'H'}
+
+
+def partition_of(payload):
+    """
+    :return: (devID, 'YYYY-MM-DD') of the partition a payload is archived in
+    """
+    date = time.gmtime(payload['meta.deviceepoch'])
+    return payload['meta.devID'], '%04d-%02d-%02d' % (date.tm_year, date.tm_mon, date.tm_mday)
+
+
+def valid_device(dev_id) -> bool:
+    """
+    :return: True if dev_id can be used as a directory name under the archive root. An id that is empty, "." or "..",
+    or has a path separator in it, could otherwise point outside of it
+    """
+    return isinstance(dev_id, str) and dev_id not in ('', '.', '..') and not any(c in dev_id for c in '/\\\0')
+
+
+def parse_lines(lines):
+    """
+    Reads payloads in the str() form that the Pi and fleetgen.py publish, one per line, like Memory.verify() does
+
+    :param lines: iterable of lines
+    :return: generator of payloads
+    """
+    decoder = json.JSONDecoder()
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield decoder.decode(line.replace('\'', '\"'))
+            except json.JSONDecodeError:
+                continue
+
+
+class ArchiveWriter:
+    """
+    Buffers payloads by partition and writes them out as columns. Payloads can arrive in any order; when a partition
+    that is already on disk gets more rows, the old and new rows are merged and rewritten. Rows with the same time and
+    geohash are the same fix, and are only kept once (the newest copy), so exporting the same data again changes
+    nothing.
+    """
+    def __init__(self, root, max_rows=1000000):
+        """
+        :param root: directory of the archive
+        :param max_rows: number of buffered rows at which every buffered partition is written out
+        """
+        self.root = root
+        self.max_rows = max_rows
+        self.buffers = {}
+        self.buffered = 0
+        self.written = 0
+        self.rejected = 0
+
+    def add(self, payload):
+        """
+        Adds one payload. Payloads without a location (e.g. wifilocation payloads that were never geolocated) are
+        skipped, as is anything that isn't a location payload at all. So are payloads whose meta.devID is not a valid
+        directory name (see valid_device()); those are counted in self.rejected.
+
+        :return: True if the payload will be archived
+        """
+        if 'loc' not in payload or 'meta.deviceepoch' not in payload or 'meta.devID' not in payload:
+            return False
+        if not valid_device(payload['meta.devID']):
+            self.rejected += 1
+            return False
+        self.buffers.setdefault(partition_of(payload), []).append(payload)
+        self.buffered += 1
+        if self.buffered >= self.max_rows:
+            self.flush()
+        return True
+
+    def extend(self, payloads):
+        for payload in payloads:
+            self.add(payload)
+
+    def flush(self):
+        """
+        Writes every buffered partition to disk
+        """
+        for (dev_id, day), payloads in self.buffers.items():
+            self.write_partition(dev_id, day, payloads)
+        self.buffers = {}
+        self.buffered = 0
+
+    def write_partition(self, dev_id, day, payloads):
+        if not valid_device(dev_id):
+            raise ValueError("not a valid device id for the archive: " + repr(dev_id))
+        path = os.path.join(self.root, dev_id, day)
+        unique = {}
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            old = Partition(path)
+            for row in old.rows():
+                unique[row['epoch'], row['geohash']] = row
+            old.close()
+        for payload in payloads:
+            row = self.row(payload)
+            unique[row['epoch'], row['geohash']] = row
+        rows = sorted(unique.values(), key=lambda row: row['epoch'])
+        dictionaries = {}
+        os.makedirs(path, exist_ok=True)
+
+        types = dictionaries.setdefault('type', [])
+        geo_names = sorted({key for row in rows for key in row['geo']})
+        for name in geo_names:
+            dictionaries[name] = [None]
+
+        columns = {'geohash.u64': array.array('Q'), 'epoch.i32': array.array('i'), 'error.f32': array.array('f'),
+                   'type.u8': array.array('B')}
+        for column, _ in FLOAT_COLUMNS:
+            columns[column + '.f32'] = array.array('f')
+        for name in geo_names:
+            columns[name + '.u16'] = array.array('H')
+
+        codes = {key: {} for key in dictionaries}
+        base = rows[0]['epoch']
+        previous = base
+        for row in rows:
+            columns['geohash.u64'].append(row['geohash'])
+            columns['epoch.i32'].append(row['epoch'] - previous)
+            previous = row['epoch']
+            columns['error.f32'].append(row['error'])
+            for column, _ in FLOAT_COLUMNS:
+                columns[column + '.f32'].append(row[column])
+            columns['type.u8'].append(self.code(codes['type'], types, row['type']))
+            for name in geo_names:
+                value = row['geo'].get(name)
+                columns[name + '.u16'].append(0 if value is None else self.code(codes[name], dictionaries[name], value))
+
+        for filename, values in columns.items():
+            with open(os.path.join(path, filename), 'wb') as file:
+                values.tofile(file)
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'count': len(rows), 'base_epoch_ms': base, 'dictionaries': dictionaries}, file)
+        self.written += len(payloads)
+
+    @staticmethod
+    def code(codes, dictionary, value):
+        """
+        :return: the dictionary code of value, adding it to the dictionary if it is new
+        """
+        if value not in codes:
+            codes[value] = len(dictionary)
+            dictionary.append(value)
+        return codes[value]
+
+    @staticmethod
+    def row(payload) -> dict:
+        """
+        :return: the values of a payload that are archived, in the form Partition.rows() gives them back
+        """
+        row = {'geohash': geohash.geohash_int(payload['loc']['lat'], payload['loc']['lon']),
+               'epoch': int(round(payload['meta.deviceepoch'] * 1000)),
+               'error': max(payload.get('error.lat', 0), payload.get('error.lon', 0)),
+               'type': payload.get('meta.type', 'location'),
+               'geo': {key: value for key, value in payload.items() if key.startswith('geo.')}}
+        for column, key in FLOAT_COLUMNS:
+            row[column] = payload.get(key) or 0
+        return row
+
+
+class Partition:
+    """
+    One device-day of the archive, with its columns memory mapped. Columns are memoryviews over the files, so opening
+    a partition and reading a column does not copy or parse it.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        self.count = meta['count']
+        self.base_epoch_ms = meta['base_epoch_ms']
+        self.dictionaries = meta['dictionaries']
+        self.maps = {}
+
+    def column(self, filename) -> memoryview:
+        """
+        :param filename: column file name, e.g. 'geohash.u64'
+        :return: the column as a memoryview of numbers
+        """
+        if filename not in self.maps:
+            if self.count == 0:
+                return memoryview(array.array(TYPECODES[filename.rsplit('.', 1)[1]]))
+            with open(os.path.join(self.path, filename), 'rb') as file:
+                self.maps[filename] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.maps[filename]).cast(TYPECODES[filename.rsplit('.', 1)[1]])
+
+    def epochs_ms(self):
+        """
+        :return: list of meta.deviceepoch values in milliseconds, rebuilt from the delta encoded column
+        """
+        return list(itertools.accumulate(self.column('epoch.i32'), initial=self.base_epoch_ms))[1:]
+
+    def geohashes(self) -> memoryview:
+        return self.column('geohash.u64')
+
+    def geo_names(self):
+        return [name for name in self.dictionaries if name.startswith('geo.')]
+
+    def rows(self):
+        """
+        :return: generator of every row, in the form ArchiveWriter.row() makes them
+        """
+        floats = {column: self.column(column + '.f32') for column, _ in FLOAT_COLUMNS}
+        geo = {name: self.column(name + '.u16') for name in self.geo_names()}
+        types = self.column('type.u8')
+        errors = self.column('error.f32')
+        geohashes = self.geohashes()
+        for i, epoch in enumerate(self.epochs_ms()):
+            row = {'geohash': geohashes[i], 'epoch': epoch, 'error': errors[i],
+                   'type': self.dictionaries['type'][types[i]],
+                   'geo': {name: self.dictionaries[name][codes[i]] for name, codes in geo.items() if codes[i]}}
+            for column, values in floats.items():
+                row[column] = values[i]
+            yield row
+
+    def payload(self, row, dev_id) -> dict:
+        """
+        :return: a row turned back into a payload, in the form the Uploader stores
+        """
+        lat, lon = geohash.ungeohash_int(row['geohash'])
+        payload = {'loc': {'lat': lat, 'lon': lon}, 'meta.deviceepoch': row['epoch'] / 1000, 'meta.devID': dev_id,
+                   'meta.type': row['type'], 'error.lat': row['error'], 'error.lon': row['error']}
+        for column, key in FLOAT_COLUMNS:
+            payload[key] = row[column]
+        payload.update(row['geo'])
+        return payload
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+
+
+class ArchiveReader:
+    """
+    Reads the archive back, either as raw columns (scan()) for fast analysis, or as payloads (search()), which makes
+    it a source for the query module just like query.ElasticsearchSource.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def devices(self):
+        return sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+
+    def partitions(self, dev_id, start=None, end=None):
+        """
+        :param dev_id: device to read
+        :param start: optional epoch, in seconds. Partitions of days entirely before it are skipped
+        :param end: optional epoch, in seconds. Partitions of days entirely after it are skipped
+        :return: generator of (day, Partition), in date order
+        """
+        path = os.path.join(self.root, dev_id)
+        if not valid_device(dev_id) or not os.path.isdir(path):
+            return
+        first = None if start is None else time.strftime('%Y-%m-%d', time.gmtime(start))
+        last = None if end is None else time.strftime('%Y-%m-%d', time.gmtime(end))
+        for day in sorted(os.listdir(path)):
+            if (first is None or day >= first) and (last is None or day <= last):
+                yield day, Partition(os.path.join(path, day))
+
+    def scan(self, dev_id, start=None, end=None):
+        """
+        The fast path: the epochs (in milliseconds) and 64 bit geohashes of a device's fixes, without building payloads
+
+        :return: generator of (epochs_ms, geohashes) per partition, trimmed to [start, end]
+        """
+        for day, partition in self.partitions(dev_id, start, end):
+            epochs = partition.epochs_ms()
+            low = 0 if start is None else bisect.bisect_left(epochs, start * 1000)
+            high = len(epochs) if end is None else bisect.bisect_right(epochs, end * 1000)
+            yield epochs[low:high], partition.geohashes()[low:high]
+
+    def search(self, prefixes=None, start=None, end=None, devices=None, types=None, ordered=False):
+        """
+        Same filters as query.ElasticsearchSource.search(). Results are always in time order within a device.
+
+        :return: generator of payloads
+        """
+        ranges = [geohash.prefix_range(prefix) for prefix in prefixes] if prefixes else None
+        for dev_id in devices or self.devices():
+            for day, partition in self.partitions(dev_id, start, end):
+                for row in partition.rows():
+                    if start is not None and row['epoch'] < start * 1000 or end is not None and row['epoch'] > end * 1000:
+                        continue
+                    if types and row['type'] not in types:
+                        continue
+                    if ranges and not any(low <= row['geohash'] < high for low, high in ranges):
+                        continue
+                    yield partition.payload(row, dev_id)
+                partition.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export location history to the columnar archive")
+    subparsers = parser.add_subparsers(dest='command')
+    export = subparsers.add_parser('export')
+    export.add_argument('--root', required=True, help="archive directory")
+    export.add_argument('--input', help="file of payloads, one per line. Reads from Elasticsearch if not given")
+    export.add_argument('--start', type=float, help="earliest meta.deviceepoch to export from Elasticsearch")
+    export.add_argument('--end', type=float, help="latest meta.deviceepoch to export from Elasticsearch")
+    export.add_argument('--device', action='append', help="device to export; may be given more than once")
+    args = parser.parse_args(argv)
+    if args.command != 'export':
+        parser.print_help()
+        return
+
+    writer = ArchiveWriter(args.root)
+    if args.input:
+        with (sys.stdin if args.input == '-' else open(args.input)) as file:
+            writer.extend(parse_lines(file))
+    else:
+        import query
+        from config import Config
+        source = query.ElasticsearchSource(Config.load())
+        writer.extend(source.search(start=args.start, end=args.end, devices=args.device))
+    writer.flush()
+    print("ARCHIVED::: " + str(writer.written) + " payloads", file=sys.stderr)
+    if writer.rejected:
+        print("REJECTED::: " + str(writer.rejected) + " payloads with a meta.devID that is not a valid directory name",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+import argparse, math, os, random, shutil, tempfile, time
+import archive, fleetgen
+from gpscommon import geohash
+
+"""Checks the integer geohashes the archive is built on, and measures the archive's size and scan speed.
+
+The checks, on random points:
+  - geohash_int() gives the same hash as geohash(), bit for bit, at every precision from 1 to 64 bits, and
+    ungeohash_int() decodes it to a point inside the cell
+  - prefix_range() contains a 64 bit geohash_int() exactly when the geohash() string starts with the prefix
+  - every point within the radius of a cover() is inside one of its prefixes
+
+The measurements: how much faster geohash_int() is than geohash(), the size of an hour of a simulated fleet in the
+archive against the same payloads as text, and how long ArchiveReader.scan() takes over a month of 1 Hz fixes of one
+device.
+
+    python3 bench_archive.py --points 20000 --devices 50 --days 30
+"""
+
+
+def random_point(rng):
+    return rng.uniform(-90, 90), rng.uniform(-180, 180)
+
+
+def check_geohash_int(rng, points):
+    """
+    :return: number of (point, precision) pairs where geohash_int() and geohash() differ, or the cell decoded by
+    ungeohash_int() does not contain the point
+    """
+    failures = 0
+    for _ in range(points):
+        lat, lon = random_point(rng)
+        for bits in range(1, 65):
+            n = geohash.geohash_int(lat, lon, bits)
+            if geohash.int_to_geohash(n, bits) != geohash.geohash(lat, lon, bits)[0]:
+                failures += 1
+                continue
+            center_lat, center_lon = geohash.ungeohash_int(n, bits)
+            if abs(center_lat - lat) > 90 / 2**(bits // 2) or abs(center_lon - lon) > 180 / 2**((bits + 1) // 2):
+                failures += 1
+    return failures
+
+
+def check_prefix_range(rng, points):
+    """
+    :return: number of (point, prefix) pairs where prefix_range() and a string prefix match disagree. The prefixes are
+    those of the point itself and of another random point, at every length up to 12 digits
+    """
+    failures = 0
+    for _ in range(points):
+        lat, lon = random_point(rng)
+        n = geohash.geohash_int(lat, lon)
+        string = geohash.geohash(lat, lon, 64)[0]
+        other = geohash.geohash(*random_point(rng), 64)[0]
+        for length in range(1, 13):
+            for prefix in (string[:length], other[:length]):
+                low, high = geohash.prefix_range(prefix)
+                if (low <= n < high) != string.startswith(prefix):
+                    failures += 1
+    return failures
+
+
+def check_cover(rng, circles, samples=200):
+    """
+    :return: number of points within the radius of a cover() that none of its prefixes contain
+    """
+    failures = 0
+    for _ in range(circles):
+        lat, lon = rng.uniform(-80, 80), rng.uniform(-180, 180)
+        radius = 10**rng.uniform(1, 5)
+        prefixes = geohash.cover(lat, lon, radius)
+        for _ in range(samples):
+            distance = radius * math.sqrt(rng.random()) * 0.999
+            angle = rng.uniform(0, 2 * math.pi)
+            point = fleetgen.offset(lat, lon, distance * math.cos(angle), distance * math.sin(angle))
+            if geohash.haversine(lat, lon, point[0], point[1]) > radius:
+                continue
+            string = geohash.geohash(point[0], point[1], 40)[0]
+            if not any(string.startswith(prefix) for prefix in prefixes):
+                failures += 1
+    return failures
+
+
+def time_geohash(rng, points, bits=35):
+    """
+    :return: (microseconds per geohash(), microseconds per geohash_int()) at the given precision
+    """
+    coordinates = [random_point(rng) for _ in range(points)]
+    start = time.perf_counter()
+    for lat, lon in coordinates:
+        geohash.geohash(lat, lon, bits)
+    strings = time.perf_counter() - start
+    start = time.perf_counter()
+    for lat, lon in coordinates:
+        geohash.geohash_int(lat, lon, bits)
+    ints = time.perf_counter() - start
+    return strings / points * 1e6, ints / points * 1e6
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def measure_size(root, devices, seconds=3600):
+    """
+    :return: (bytes of the payloads as text, one per line, bytes of the archive of them)
+    """
+    fleet = fleetgen.Fleet(devices, seed=1)
+    writer = archive.ArchiveWriter(root)
+    text = 0
+    for second in range(seconds):
+        for payload in fleet.tick(1, 1.8e9 + second):
+            text += len(str(payload)) + 1
+            writer.add(payload)
+    writer.flush()
+    return text, directory_size(root)
+
+
+def measure_scan(root, days):
+    """
+    Archives `days` days of 1 Hz fixes of one device, and scans them, finding the extent of the geohashes
+
+    :return: (rows scanned, seconds the scan took)
+    """
+    fleet = fleetgen.Fleet(1, seed=2, wifi_rate=0)
+    writer = archive.ArchiveWriter(root)
+    for second in range(days * 86400):
+        writer.extend(fleet.tick(1, 1.8e9 + second))
+    writer.flush()
+    dev_id = fleet.devices[0].dev_id
+    reader = archive.ArchiveReader(root)
+    start = time.perf_counter()
+    rows, low, high = 0, math.inf, -math.inf
+    for epochs, hashes in reader.scan(dev_id):
+        rows += len(epochs)
+        low, high = min(low, min(hashes)), max(high, max(hashes))
+    return rows, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the integer geohashes and measure the columnar archive")
+    parser.add_argument('--points', type=int, default=20000, help="random points per check")
+    parser.add_argument('--devices', type=int, default=50, help="devices in the hour whose size is measured")
+    parser.add_argument('--days', type=int, default=30, help="days of fixes of one device to scan; 0 to skip")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    print("geohash_int: %d mismatches in %d hashes" % (check_geohash_int(rng, args.points // 10),
+                                                         args.points // 10 * 64))
+    print("prefix_range: %d mismatches in %d prefixes" % (check_prefix_range(rng, args.points), args.points * 24))
+    print("cover: %d points outside the cover in %d" % (check_cover(rng, args.points // 200), args.points // 200 * 200))
+    strings, ints = time_geohash(rng, args.points)
+    print("geohash: %.1fus, geohash_int: %.1fus at 35 bits (%.1fx)" % (strings, ints, strings / ints))
+
+    scratch = tempfile.mkdtemp(prefix='bench_archive-')
+    try:
+        text, stored = measure_size(os.path.join(scratch, 'size'), args.devices)
+        print("one hour of %d devices: text=%.1fMB archive=%.1fMB" % (args.devices, text / 1e6, stored / 1e6))
+        if args.days:
+            rows, seconds = measure_scan(os.path.join(scratch, 'scan'), args.days)
+            print("scan: %d rows of one device in %.2fs" % (rows, seconds))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
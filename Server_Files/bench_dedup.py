@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+import argparse, math, random, time
+import dedup, fleetgen, memory
+from config import Config
+
+"""Replays a simulated fleet through Memory.receive() out of order and with duplicates, and checks that the result is
+the same as processing it in order.
+
+The fixes of every device are delivered up to --jitter seconds late, in random order, and a share of them (--duplicates)
+is delivered a second time up to --redelivery seconds later, as a reconnecting client or a redelivering broker would.
+Per device, the uploads (device, time and weight) and the fixes sent to the geocoder and geolocator must match an
+in-order replay of the same fixes, and every duplicate must be dropped. Nothing is sent anywhere: the queues the
+worker threads would read from are replaced with lists.
+
+RollingBloom is checked separately: every one of the last `capacity` keys added must be reported as seen, and keys never
+added are counted to measure the false positive rate.
+
+    python3 bench_dedup.py --devices 20 --seconds 5400 --jitter 3 --duplicates 0.05
+"""
+
+
+class Sink(list):
+    """
+    Stands in for a ConsumerQueue
+    """
+    def put(self, payload):
+        self.append(payload)
+
+    def stop(self, timeout=None):
+        pass
+
+
+def fleet_stream(devices, seconds, seed=1):
+    """
+    :return: list of the payloads of a simulated fleet, in the order they were produced
+    """
+    fleet = fleetgen.Fleet(devices, seed=seed)
+    messages = []
+    for second in range(seconds):
+        messages.extend(fleet.tick(1, 1.8e9 + second))
+    return messages
+
+
+def disorder(messages, jitter, duplicates, redelivery, rng):
+    """
+    :return: list of (arrival time, payload), sorted by arrival time, with up to `jitter` seconds of delay per payload
+    and a `duplicates` share of them delivered again within `redelivery` seconds
+    """
+    arrivals = []
+    for payload in messages:
+        arrival = payload["meta.deviceepoch"] + rng.uniform(0, jitter)
+        arrivals.append((arrival, payload))
+        if rng.random() < duplicates:
+            arrivals.append((arrival + rng.uniform(0, redelivery), payload))
+    arrivals.sort(key=lambda item: item[0])
+    return arrivals
+
+
+def replay(arrivals, config):
+    """
+    Feeds (arrival time, payload) pairs to a Memory, calling release() once a simulated second as tick() would
+
+    :return: (the Memory, number of payloads receive() dropped, seconds spent in receive() and release())
+    """
+    mem = memory.Memory(config)
+    mem.upl_queue = mem.mov_queue = Sink()
+    mem.geo_queue, mem.glo_queue, mem.log_queue = Sink(), Sink(), Sink()
+    dropped = 0
+    ticked = -math.inf
+    start = time.perf_counter()
+    for arrival, payload in arrivals:
+        payload = dict(payload, **{"meta.messageepoch": arrival})
+        if not mem.receive(payload):
+            dropped += 1
+        if arrival - ticked >= 1:
+            mem.release(arrival)
+            ticked = arrival
+    mem.release(math.inf)
+    return mem, dropped, time.perf_counter() - start
+
+
+def per_device(mem):
+    """
+    :return: {devID: (uploads, fixes sent to the geocoder, fixes sent to the geolocator)}, to compare two replays by
+    """
+    result = {}
+    for name, payloads in (("upload", mem.upl_queue), ("geocode", mem.geo_queue), ("geolocate", mem.glo_queue)):
+        for payload in payloads:
+            entry = (payload["meta.type"], payload["meta.deviceepoch"], round(payload.get("meta.weight", 0), 6))
+            result.setdefault(payload["meta.devID"], {}).setdefault(name, []).append(entry)
+    for streams in result.values():
+        # the Geolocator answers asynchronously, so only which wifi fixes it was sent matters, not their order
+        streams["geolocate"] = sorted(streams.get("geolocate", []))
+    return result
+
+
+def bloom_check(capacity, error_rate, probes=100000, seed=1):
+    """
+    :return: (keys among the last `capacity` added that were reported unseen, share of `probes` keys never added that
+    were reported seen, bytes used)
+    """
+    rng = random.Random(seed)
+    bloom = dedup.RollingBloom(capacity, error_rate)
+    keys = [("dev", rng.random()) for _ in range(capacity * 3)]
+    for key in keys:
+        bloom.add(key)
+    missed = sum(1 for key in keys[-capacity:] if not bloom.add(key))
+    false = sum(1 for _ in range(probes) if bloom.add(("new", rng.random())))
+    return missed, false / probes, len(bloom.current) + len(bloom.previous)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a simulated fleet out of order and with duplicates")
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--seconds', type=int, default=5400, help="seconds of fixes per device")
+    parser.add_argument('--jitter', type=float, default=3, help="most a payload is delivered late, in seconds")
+    parser.add_argument('--duplicates', type=float, default=0.05, help="share of payloads delivered twice")
+    parser.add_argument('--redelivery', type=float, default=60, help="most a duplicate is delivered late, in seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    # summaries would be loaded from Elasticsearch, so they are left out
+    config = Config({'summary_interval': 0})
+    rng = random.Random(args.seed)
+    messages = fleet_stream(args.devices, args.seconds, args.seed)
+    arrivals = disorder(messages, args.jitter, args.duplicates, args.redelivery, rng)
+
+    ordered, _, _ = replay([(payload["meta.deviceepoch"], payload) for payload in messages], config)
+    shuffled, dropped, seconds = replay(arrivals, config)
+    expected, actual = per_device(ordered), per_device(shuffled)
+    different = sorted(dev_id for dev_id in expected.keys() | actual.keys()
+                       if expected.get(dev_id) != actual.get(dev_id))
+
+    print("payloads=%d delivered=%d duplicates=%d dropped=%d" %
+          (len(messages), len(arrivals), len(arrivals) - len(messages), dropped))
+    print("devices=%d different=%d %s" % (len(expected), len(different), " ".join(different)))
+    print("receive: %.1fus per payload, including geocode()" % (seconds / len(arrivals) * 1e6))
+
+    buffers = [dedup.ReorderBuffer(config.reorder_window, config.reorder_size, config.reorder_reset)
+               for _ in range(args.devices)]
+    index = {}
+    start = time.perf_counter()
+    for arrival, payload in arrivals:
+        if payload["meta.type"] != "wifilocation":
+            buffer = index.get(payload["meta.devID"])
+            if buffer is None:
+                buffer = index[payload["meta.devID"]] = buffers[len(index)]
+            buffer.push(payload, arrival)
+    print("ReorderBuffer.push: %.1fus per payload" % ((time.perf_counter() - start) / len(arrivals) * 1e6))
+
+    missed, false_rate, size = bloom_check(config.dedup_capacity, 0.0001)
+    print("RollingBloom: capacity=%d bytes=%d missed=%d false_positive_rate=%.5f" %
+          (config.dedup_capacity, size, missed, false_rate))
+
+
+if __name__ == '__main__':
+    main()
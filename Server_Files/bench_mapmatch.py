@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+import argparse, json, os, random, tempfile, time
+import fleetgen, mapmatch
+from gpscommon import geohash
+
+"""Measures how fast the map matcher snaps fixes and how often it picks the right road.
+
+A square grid of straight roads (rows "h<n>" running east-west and columns "v<n>" running north-south, meeting at every
+intersection) is written as GeoJSON and read back with RoadNetwork.load(), the same as a road_network file. Simulated
+devices drive random routes along the grid with fleetgen, and the fixes of every moving device go through its own
+Matcher, as the Snapper does; a device that stops has its window flushed. Since the devices really are on the roads,
+every snapped fix can be checked against the road the device was on when it was taken (either road, at an
+intersection), and against its true position.
+
+    python3 bench_mapmatch.py --devices 50 --seconds 1800 --grid 20 --spacing 500
+    python3 bench_mapmatch.py --save roads.json    # also keep the grid, e.g. as a road_network for the server
+"""
+
+
+def grid(lat, lon, size, spacing):
+    """
+    :param lat: latitude of the south west corner
+    :param lon: longitude of the south west corner
+    :param size: number of roads each way
+    :param spacing: distance between neighbouring roads, in meters
+    :return: (GeoJSON FeatureCollection of the roads, size x size list of the (lat, lon) of every intersection)
+    """
+    nodes = [[fleetgen.offset(lat, lon, row * spacing, col * spacing) for col in range(size)] for row in range(size)]
+    features = []
+    for name, lines in (("h", nodes), ("v", [list(column) for column in zip(*nodes)])):
+        for number, line in enumerate(lines):
+            features.append({"type": "Feature", "properties": {"id": name + str(number)},
+                             "geometry": {"type": "LineString", "coordinates": [[lon, lat] for lat, lon in line]}})
+    return {"type": "FeatureCollection", "features": features}, nodes
+
+
+def route(nodes, length, rng):
+    """
+    :return: a random walk of `length` steps between neighbouring intersections, followed by the same walk back, so
+    that a device going round it never leaves the roads
+    """
+    size = len(nodes)
+    row, col = rng.randrange(size), rng.randrange(size)
+    walk = [(row, col)]
+    while len(walk) <= length:
+        d_row, d_col = rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+        step = (row + d_row, col + d_col)
+        # stay on the grid, and don't turn straight back
+        if 0 <= step[0] < size and 0 <= step[1] < size and (len(walk) < 2 or walk[-2] != step):
+            row, col = step
+            walk.append(step)
+    walk += walk[-2:0:-1]
+    return [nodes[row][col] for row, col in walk]
+
+
+def measure(network, fleet, seconds):
+    """
+    Drives the fleet for `seconds` seconds, matching the fixes of every moving device
+
+    :return: (fixes matched, CPU seconds spent matching, fixes snapped to a road the device was on, sum of the distances
+    from the snapped points to the true positions, sum of the distances from the fixes to the true positions)
+    """
+    matchers = {}
+    truth = {}
+    matched = correct = 0
+    snapped_error = raw_error = 0.0
+    cpu = 0.0
+
+    def check(decided):
+        nonlocal matched, correct, snapped_error, raw_error
+        for payload in decided:
+            lat, lon, roads = truth.pop(id(payload))
+            matched += 1
+            correct += payload.get("road.id") in roads
+            snapped = payload.get("road.loc", payload["loc"])
+            snapped_error += geohash.haversine(lat, lon, snapped["lat"], snapped["lon"])
+            raw_error += geohash.haversine(lat, lon, payload["loc"]["lat"], payload["loc"]["lon"])
+
+    for second in range(seconds):
+        for device, payload in zip(fleet.devices, fleet.tick(1, 1.8e9 + second)):
+            matcher = matchers.get(device.dev_id)
+            if not device.moving:
+                if matcher is not None:
+                    start = time.process_time()
+                    decided = matcher.flush()
+                    cpu += time.process_time() - start
+                    check(decided)
+                continue
+            if matcher is None:
+                matcher = matchers[device.dev_id] = mapmatch.Matcher(network)
+            roads = {network.segments[index][0] for _, index, _, _ in network.candidates(device.lat, device.lon, 1)}
+            truth[id(payload)] = (device.lat, device.lon, roads)
+            start = time.process_time()
+            decided = matcher.push(payload)
+            cpu += time.process_time() - start
+            check(decided)
+    for matcher in matchers.values():
+        check(matcher.flush())
+    return matched, cpu, correct, snapped_error, raw_error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure map matching speed and accuracy on a grid of roads")
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--seconds', type=int, default=1800, help="simulated seconds, one fix per device per second")
+    parser.add_argument('--grid', type=int, default=20, help="number of roads each way")
+    parser.add_argument('--spacing', type=float, default=500, help="meters between roads")
+    parser.add_argument('--noise', type=float, default=4, help="GPS noise, in meters")
+    parser.add_argument('--save', help="write the road network to this GeoJSON file")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    roads, nodes = grid(39.1854, -76.8508, args.grid, args.spacing)
+    path = args.save or tempfile.mkstemp(prefix='bench_mapmatch-', suffix='.json')[1]
+    try:
+        with open(path, 'w') as file:
+            json.dump(roads, file)
+        start = time.perf_counter()
+        network = mapmatch.RoadNetwork.load(path)
+        print("network: %d roads, %d segments, loaded in %.3fs" %
+              (len(roads["features"]), len(network.segments), time.perf_counter() - start))
+    finally:
+        if not args.save:
+            os.remove(path)
+
+    routes = [route(nodes, 4 * args.grid, rng) for _ in range(args.devices)]
+    fleet = fleetgen.Fleet(args.devices, seed=args.seed, routes=routes, noise=args.noise, wifi_rate=0)
+    matched, cpu, correct, snapped_error, raw_error = measure(network, fleet, args.seconds)
+    print("matched: %d fixes in %.2f CPU seconds, %.0f fixes/s per core, %.0fus per fix" %
+          (matched, cpu, matched / cpu, cpu / matched * 1e6))
+    print("accuracy: %.2f%% on the right road, %.1fm from the true position snapped, %.1fm unsnapped" %
+          (correct / matched * 100, snapped_error / matched, raw_error / matched))
+
+
+if __name__ == '__main__':
+    main()
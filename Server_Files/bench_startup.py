@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import argparse, json, os, statistics, subprocess, sys, tempfile, threading, time
+import bench_upload, fleetgen
+
+"""Measures how long the server takes to start: importing mqttelasticsearch, and getting the first message into
+Elasticsearch.
+
+Every run is a fresh interpreter, since most of the cost is imports, and the threads and clients that are only built
+once the first message needs them. The first message is a moving fix, passed to Memory.verify() and Memory.receive()
+as the mqtt client's on_message() does, with reorder_window set to 0 so it is released straight away. The time until
+it is uploaded is measured up to the first _bulk request arriving at a local stand-in for Elasticsearch (see
+bench_upload.py), reached without TLS or request signing; the mqtt broker is not involved.
+
+    python3 bench_startup.py --runs 10
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# run in a fresh interpreter: the server is imported before this module, so that nothing it imports is loaded yet
+CHILD = ("import time; start = time.perf_counter(); import mqttelasticsearch; imported = time.perf_counter(); "
+         "import bench_startup, sys; bench_startup.child(imported - start, int(sys.argv[1]), sys.argv[2], sys.argv[3])")
+
+
+def child(seconds, port, message, log_file):
+    """
+    Builds a Memory and receives one message. Prints a JSON object of the seconds each step took, and the time.time()
+    receive() was called at, and waits for the upload to finish.
+
+    :param seconds: how long importing mqttelasticsearch took
+    """
+    import memory
+    from config import Config
+    start = time.perf_counter()
+
+    class StandInConfig(Config):
+        def elasticsearch(self):
+            from elasticsearch import Elasticsearch
+            return Elasticsearch(hosts=[{'host': '127.0.0.1', 'port': port}])
+
+    mem = memory.Memory(StandInConfig({'reorder_window': 0, 'summary_interval': 0, 'log_file': log_file}))
+    built = time.perf_counter()
+    received_at = time.time()
+    payload = mem.verify(message.encode('utf-8'))
+    payload["meta.messageepoch"] = received_at
+    mem.receive(payload)
+    received = time.perf_counter()
+    print(json.dumps({"import": seconds, "memory": built - start, "receive": received - built,
+                      "received_at": received_at}), flush=True)
+    mem.stop_threads()
+
+
+def moving_fix():
+    """
+    :return: a location payload of a simulated device, moving fast enough to be uploaded, in the form the Pi sends
+    """
+    fleet = fleetgen.Fleet(1, seed=1, wifi_rate=0)
+    second = 0
+    while True:
+        payload = next(fleet.tick(1, time.time() + second))
+        if payload["pos.speed"] > 5:
+            return str(payload)
+        second += 1
+
+
+def time_first_message(runs, server, log_file):
+    """
+    :return: list of dicts of the seconds taken by `import mqttelasticsearch`, Memory(), receive(), and from receive()
+    to the first _bulk request, one per fresh interpreter
+    """
+    message = moving_fix()
+    results = []
+    for _ in range(runs):
+        server.first = None
+        output = subprocess.check_output([sys.executable, "-c", CHILD, str(server.server_address[1]), message,
+                                          log_file], cwd=HERE)
+        result = json.loads(output.decode('utf-8').splitlines()[0])
+        if server.first is None:
+            raise RuntimeError("the message was not uploaded, see " + log_file)
+        result["upload"] = server.first - result.pop("received_at")
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure server import time and time to the first upload")
+    parser.add_argument('--runs', type=int, default=10, help="fresh interpreters to start")
+    parser.add_argument('--log-file', default=os.path.join(tempfile.gettempdir(), 'bench_startup.log'),
+                        help="log file of the server under test")
+    args = parser.parse_args(argv)
+
+    server = bench_upload.StandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results = time_first_message(args.runs, server, args.log_file)
+    finally:
+        server.shutdown()
+    for key, name in (("import", "import mqttelasticsearch"), ("memory", "Memory()"), ("receive", "first receive()"),
+                      ("upload", "first receive() to first upload")):
+        times = [result[key] * 1e3 for result in results]
+        print("%s: median=%.1fms min=%.1fms max=%.1fms" % (name, statistics.median(times), min(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
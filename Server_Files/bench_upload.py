@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+import argparse, http.server, json, queue, threading, time
+import fleetgen, memory
+from config import Config
+
+"""Measures how many documents per second the Uploader gets into Elasticsearch, for several bulk sizes.
+
+Payloads from a simulated fleet are sent with Uploader.upload_batch(), the same call the Uploader thread makes for every
+batch it takes off its queue, so the time includes adding the geohash strings, building the bulk actions, serialising
+them, the HTTP request and reading the response. Without --host, the requests go to a stand-in on a local port that
+answers index creation and _bulk requests the way Elasticsearch 6 does, without storing anything; the time it spends
+answering is measured separately and left out of the Uploader's share. With --host, they go to a real cluster over
+plain HTTP, without the TLS and request signing Config.elasticsearch() adds for AWS.
+
+    python3 bench_upload.py --sizes 100 500 2000 --documents 50000
+    python3 bench_upload.py --host 127.0.0.1 --port 9200
+"""
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """
+    Answers PUT /<index> and POST /_bulk like Elasticsearch, and keeps count of the documents and the time spent. first
+    is the time.time() the first _bulk request arrived at, or None
+    """
+    def __init__(self, port=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.lock = threading.Lock()
+        self.indices = set()
+        self.documents = 0
+        self.busy = 0.0
+        self.first = None
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # one send per response; unbuffered, the headers and body go out separately and wait on delayed acknowledgements
+    wbufsize = 65536
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        start = time.perf_counter()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        name = self.path.strip('/').split('?')[0]
+        with self.server.lock:
+            exists = name in self.server.indices
+            self.server.indices.add(name)
+        if exists:
+            self.reply(400, {"error": {"type": "resource_already_exists_exception"}, "status": 400})
+        else:
+            self.reply(200, {"acknowledged": True, "index": name})
+        with self.server.lock:
+            self.server.busy += time.perf_counter() - start
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if self.server.first is None:
+            self.server.first = time.time()
+        lines = self.rfile.read(int(self.headers.get('Content-Length', 0))).splitlines()
+        items = []
+        for line in lines[::2]:
+            action = json.loads(line)["index"]
+            items.append({"index": {"_index": action["_index"], "_type": action["_type"], "_id": action["_id"],
+                                    "_version": 1, "result": "created", "status": 201}})
+        self.reply(200, {"took": 1, "errors": False, "items": items})
+        with self.server.lock:
+            self.server.documents += len(items)
+            self.server.busy += time.perf_counter() - start
+
+
+def measure(uploader, payloads, size, server=None):
+    """
+    :param uploader: the Uploader, with its client set
+    :param payloads: payloads to upload
+    :param size: documents per bulk request
+    :param server: the StandIn the client talks to, if any
+    :return: (seconds taken, of which seconds spent in the stand-in)
+    """
+    busy = server.busy if server is not None else 0
+    start = time.perf_counter()
+    for first in range(0, len(payloads), size):
+        uploader.upload_batch([dict(payload) for payload in payloads[first:first + size]])
+    elapsed = time.perf_counter() - start
+    return elapsed, (server.busy - busy if server is not None else 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure bulk upload throughput")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 2000], help="documents per bulk request")
+    parser.add_argument('--documents', type=int, default=50000, help="documents uploaded per size")
+    parser.add_argument('--host', help="Elasticsearch host; a local stand-in is used if not given")
+    parser.add_argument('--port', type=int, default=9200)
+    args = parser.parse_args(argv)
+    from elasticsearch import Elasticsearch
+
+    server = None
+    host, port = args.host, args.port
+    if host is None:
+        server = StandIn()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+    fleet = fleetgen.Fleet(200, seed=1, wifi_rate=0)
+    payloads = []
+    second = 0
+    while len(payloads) < args.documents:
+        payloads.extend(fleet.tick(1, 1.8e9 + second))
+        second += 1
+    payloads = payloads[:args.documents]
+
+    log_queue = queue.Queue()
+    config = Config({'es_index_prefix': 'bench-upload-'})
+    uploader = memory.Uploader("Uploader", None, config, log_queue)
+    uploader._esnode = Elasticsearch(hosts=[{'host': host, 'port': port}], timeout=60)
+    for size in args.sizes:
+        elapsed, busy = measure(uploader, payloads, size, server)
+        print("bulk_size=%d documents=%d seconds=%.2f documents/s=%.0f uploader=%.1fus/document%s" %
+              (size, len(payloads), elapsed, len(payloads) / elapsed, (elapsed - busy) / len(payloads) * 1e6,
+               " stand-in=%.1fus/document" % (busy / len(payloads) * 1e6) if server is not None else ""))
+    errors = log_queue.qsize()
+    if errors:
+        print("%d errors logged, e.g. %s" % (errors, log_queue.get()[1].strip()))
+    if server is not None:
+        print("stand-in: %d documents into %d indices" % (server.documents, len(server.indices)))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
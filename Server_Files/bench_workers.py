@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+import argparse, os, tempfile, time
+import fleetgen, supervisor
+from config import Config
+
+"""Measures how the number of messages processed per second scales with the number of supervisor workers.
+
+For each worker count, starts the workers against a broker, waits until every one of them has had its heartbeat message
+come back, publishes a backlog of simulated fleet messages to the per-device topics, and times how long the workers take
+to receive all of them. Elasticsearch is not needed: the uploads fail and are logged, which costs the same for every
+worker count. The broker has to be a real one (Mosquitto) for the numbers to mean anything, since a slow broker caps
+every run at its own rate.
+
+Besides the rate, it prints the CPU time the workers used per message and the share of the messages each worker got.
+Since every worker only subscribes to its own buckets, CPU per message should stay the same as workers are added, and
+the rate should grow with them as long as there are free cores (and the broker keeps up).
+
+    mosquitto -p 1883 &
+    python3 bench_workers.py --workers 1 2 4 --devices 200 --fixes 100
+"""
+
+
+def measure(config, workers, messages, qos=1, timeout=300):
+    """
+    :param config: Config with the broker settings
+    :param workers: number of worker processes
+    :param messages: payloads to publish
+    :param qos: mqtt quality of service to publish with
+    :param timeout: longest time to wait for the workers to catch up, in seconds
+    :return: (messages received by the workers, seconds from the first publish until the last was received, CPU
+    seconds the workers used in that time, list of the messages each worker received)
+    """
+    config = Config(dict(config.values, workers=workers, stats_interval=1,
+                         mqtt_client_id='bench-%d-%d' % (os.getpid(), workers)))
+    boss = supervisor.Supervisor(config)
+    for worker in boss.workers:
+        boss.start(worker)
+    try:
+        deadline = time.time() + 60
+        while not all(worker.heartbeat > worker.started for worker in boss.workers):
+            if time.time() > deadline:
+                raise RuntimeError("workers did not connect to the broker")
+            boss.collect(0.5)
+        # the counters come with the heartbeats, once a second
+        boss.collect(1.5)
+        cpu = [worker.counters['cpu'] for worker in boss.workers]
+        username, password = config.mqtt_credentials()
+        sink = fleetgen.MqttSink(config.mqtt_host, config.mqtt_port, config.mqtt_topic, qos=qos, username=username,
+                                 password=password)
+        start = time.time()
+        for payload in messages:
+            sink.send(payload)
+        received = 0
+        while time.time() - start < timeout:
+            boss.collect(0.2)
+            received = boss.stats()['received']
+            if received >= len(messages):
+                break
+        elapsed = time.time() - start
+        sink.close()
+        boss.collect(1.5)
+        used = sum(worker.counters['cpu'] - before for worker, before in zip(boss.workers, cpu))
+        return received, elapsed, used, [worker.counters['received'] for worker in boss.workers]
+    finally:
+        boss.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure supervisor throughput against a local broker")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--fixes', type=int, default=100, help="fixes published per device")
+    parser.add_argument('--qos', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix='bench_workers-')
+    usr_file = os.path.join(scratch, 'usrfile.pswd')
+    with open(usr_file, 'w') as file:
+        file.write('bench\nbench\n')
+    config = Config({'mqtt_host': args.host, 'mqtt_port': args.port, 'usr_file': usr_file,
+                     'log_file': os.path.join(scratch, 'mqtt-es.log')})
+
+    fleet = fleetgen.Fleet(args.devices, seed=1, wifi_rate=0)
+    messages = []
+    for second in range(args.fixes):
+        messages.extend(fleet.tick(1, 1.8e9 + second))
+
+    base = None
+    for workers in args.workers:
+        received, elapsed, cpu, shares = measure(config, workers, messages, args.qos)
+        rate = received / elapsed
+        base = base or rate
+        print("workers=%d received=%d/%d seconds=%.2f messages/s=%.0f speedup=%.2f cpu/message=%.0fus shares=%s" %
+              (workers, received, len(messages), elapsed, rate, rate / base, cpu / max(received, 1) * 1e6,
+               "/".join(str(share) for share in shares)))
+
+
+if __name__ == '__main__':
+    main()
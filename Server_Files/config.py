@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+import json, os
+
+
+class Config:
+    """
+    Settings for the server side of the pipeline, so that nothing has to be hard-coded into the threads.
+
+    Values are read from DEFAULTS first, then from a JSON file (the path given to load(), or the MQTTES_CONFIG
+    environment variable), then from environment variables named MQTTES_<KEY IN UPPER CASE>. Environment values are
+    converted to the type of the default value, so MQTTES_MQTT_PORT=1884 is read as an int. Optional settings default to
+    an empty string, meaning "off".
+
+    Credentials are still kept in the key files described in the README, and are only read the first time they are
+    needed. The AWS signer is also built on first use, so that requests_aws4auth is not imported until the Uploader
+    actually talks to Elasticsearch.
+    """
+    DEFAULTS = {
+        'keys_file': '/home/ubuntu/keys/api-keys.txt',
+        'usr_file': '/home/ubuntu/keys/usrfile.pswd',
+        'log_file': '/home/ubuntu/FILES/mqtt-es/mqtt-es.log',
+        'es_endpoint': 'search-chriswillelasticsearch-sbzs5dhk3efss3t4bidlxmym7u.us-east-1.es.amazonaws.com',
+        'es_port': 443,
+        'es_index_prefix': 'gps-',
+        'es_partition': 'day',
+        'es_shards': 1,
+        'es_refresh_interval': '30s',
+        'es_bulk_size': 500,
+        'aws_region': 'us-east-1',
+        'aws_service': 'es',
+        'mqtt_host': '127.0.0.1',
+        'mqtt_port': 1883,
+        'mqtt_keepalive': 60,
+        'mqtt_client_id': 'ec2instance',
+        'mqtt_topic': 'gpsd_location',
+        'road_network': '',
+        'workers': 1,
+        'worker_timeout': 30,
+        'stats_interval': 10,
+        'summary_interval': 300,
+        'reorder_window': 5,
+        'reorder_size': 64,
+        'reorder_reset': 600,
+        'dedup_capacity': 10000,
+        'stage_timers': 0,
+        'profile_dir': '',
+        'profile_seconds': 30,
+        'profile_rate': 100,
+    }
+
+    def __init__(self, values=None):
+        self.values = dict(self.DEFAULTS)
+        if values:
+            self.values.update(values)
+        self._keys = None
+        self._usr = None
+
+    @classmethod
+    def load(cls, path=None, environ=None):
+        """
+        Builds a Config from the defaults, an optional JSON file and the environment
+
+        :param path: path to a JSON file of settings. Defaults to $MQTTES_CONFIG, if it is set
+        :param environ: mapping to read overrides from. Defaults to os.environ
+        :return: the loaded Config
+        """
+        if environ is None:
+            environ = os.environ
+        config = cls()
+        path = path or environ.get('MQTTES_CONFIG')
+        if path:
+            with open(path) as file:
+                config.values.update(json.load(file))
+        for key, default in cls.DEFAULTS.items():
+            env_key = 'MQTTES_' + key.upper()
+            if env_key in environ:
+                config.values[key] = type(default)(environ[env_key])
+        return config
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['values'][key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def _read_lines(self, path, count):
+        with open(path) as file:
+            return [file.readline().replace('\n', '') for _ in range(count)]
+
+    def keys(self):
+        """
+        :return: (aws_key, aws_secret, google_api_key), read from keys_file the first time this is called
+        """
+        if self._keys is None:
+            self._keys = self._read_lines(self.keys_file, 3)
+        return self._keys
+
+    def mqtt_credentials(self):
+        """
+        :return: (username, password) for the local broker, read from usr_file the first time this is called
+        """
+        if self._usr is None:
+            self._usr = self._read_lines(self.usr_file, 2)
+        return self._usr
+
+    def check(self):
+        """
+        Reads the key files, and checks that the log file's directory is writable and the road network file (if any)
+        exists, so that a wrong path stops the server when it starts rather than the first thread that needs it
+
+        :raises OSError: if a key file cannot be read, the log directory is not writable, or the road network is missing
+        :return: None
+        """
+        self.keys()
+        self.mqtt_credentials()
+        directory = os.path.dirname(self.log_file) or '.'
+        if not os.access(directory, os.W_OK):
+            raise OSError("log directory is not writable: " + directory)
+        if self.road_network and not os.path.isfile(self.road_network):
+            raise OSError("road network file not found: " + self.road_network)
+
+    @property
+    def google_api_key(self):
+        return self.keys()[2]
+
+    def aws_auth(self):
+        """
+        Builds the request signer for the AWS Elasticsearch service. requests_aws4auth is imported here rather than at
+        module level, as it pulls in requests and takes a noticeable part of startup time.
+
+        :return: an AWS4Auth instance
+        """
+        from requests_aws4auth import AWS4Auth
+        aws_key, aws_secret, _ = self.keys()
+        return AWS4Auth(aws_key, aws_secret, self.aws_region, self.aws_service)
+
+    def elasticsearch(self):
+        """
+        Builds a client for the configured Elasticsearch endpoint, signed with aws_auth(). elasticsearch is imported here
+        for the same reason as requests_aws4auth.
+
+        :return: an Elasticsearch client
+        """
+        from elasticsearch import Elasticsearch, RequestsHttpConnection
+        return Elasticsearch(
+            hosts=[{'host': self.es_endpoint, 'port': self.es_port}],
+            http_auth=self.aws_auth(),
+            use_ssl=True,
+            verify_certs=True,
+            connection_class=RequestsHttpConnection
+        )
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+import heapq, math
+
+"""Dropping duplicated and late messages.
+
+The mqtt client keeps its session between connections and the Pi publishes again after it reconnects, so the same fix
+can arrive more than once, and fixes can arrive out of order. Memory.geocode() needs each device's fixes once each and
+in meta.deviceepoch order, so every device's GPS fixes go through a ReorderBuffer first. Wifi location messages are
+answered asynchronously by the Geolocator and are not reordered, so they are checked against a RollingBloom instead.
+"""
+
+
+class ReorderBuffer:
+    """
+    Holds a device's fixes for a short time and hands them out in meta.deviceepoch order.
+
+    A fix is released once a fix at least `window` seconds newer has arrived, once it has been held for `window`
+    seconds (see release_due()), or when more than max_size fixes are held. After that, any fix that is not newer than
+    the last one released is dropped, which also drops every duplicate of a fix already released. Duplicates of a fix
+    still held are recognised by its epoch. So a device never costs more than max_size fixes of memory, and the check is
+    exact.
+
+    The exception is a fix more than reset_after seconds older than the last one released: that is taken to mean the
+    device's clock was set back (a Pi without a real time clock can boot ahead and be corrected later), which would
+    otherwise drop every fix it sends until its clock catches up. The fixes held are released, and the buffer starts
+    again from that fix. A duplicate redelivered that late is processed a second time; its upload replaces the first.
+    """
+    def __init__(self, window=5, max_size=64, reset_after=600):
+        """
+        :param window: how long a fix can be held waiting for older ones, in seconds. 0 releases every fix straight
+        away, and only drops duplicates and late fixes
+        :param max_size: most fixes held at once
+        :param reset_after: how much older than the last fix released a fix must be to be taken as a clock reset, in
+        seconds. Should be well above how late the broker redelivers a fix
+        """
+        self.window = window
+        self.max_size = max_size
+        self.reset_after = reset_after
+        self.heap = []
+        self.epochs = set()
+        self.arrivals = 0
+        self.newest = -math.inf
+        self.released = -math.inf
+        self.dropped = 0
+        self.resets = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, payload, now) -> list:
+        """
+        :param payload: a fix of this device
+        :param now: the time it was received
+        :return: list of the fixes released by it, oldest first, except after a clock reset, when the fixes that were
+        held come before it. Empty if it was held or dropped
+        """
+        epoch = payload["meta.deviceepoch"]
+        held = []
+        if epoch < self.released - self.reset_after:
+            held = self.release(math.inf, math.inf)
+            self.newest = self.released = -math.inf
+            self.resets += 1
+        elif epoch <= self.released or epoch in self.epochs:
+            self.dropped += 1
+            return []
+        heapq.heappush(self.heap, (epoch, self.arrivals, now, payload))
+        self.arrivals += 1
+        self.epochs.add(epoch)
+        self.newest = max(self.newest, epoch)
+        return held + self.release(self.newest - self.window, now - self.window)
+
+    def release_due(self, now) -> list:
+        """
+        :param now: the current time
+        :return: list of the fixes that have been held for `window` seconds, oldest first
+        """
+        return self.release(-math.inf, now - self.window)
+
+    def release(self, epoch_limit, arrival_limit) -> list:
+        released = []
+        heap = self.heap
+        while heap and (heap[0][0] <= epoch_limit or heap[0][2] <= arrival_limit or len(heap) > self.max_size):
+            epoch, _, _, payload = heapq.heappop(heap)
+            self.epochs.discard(epoch)
+            self.released = epoch
+            released.append(payload)
+        return released
+
+
+class RollingBloom:
+    """
+    Bloom filter that remembers at least the last `capacity` keys added, in a fixed amount of memory.
+
+    Keys are added to the current generation of bits, and looked up in both it and the previous one. When the current
+    generation has had capacity keys added, it becomes the previous one and a new, empty one is started. A key is
+    checked against both, so each is sized for half of error_rate. With the defaults, two generations take 52KB and
+    about 1 key in 10000 that was never added is reported as seen (see bench_dedup.py).
+    """
+    def __init__(self, capacity=10000, error_rate=0.0001):
+        """
+        :param capacity: number of keys per generation
+        :param error_rate: chance of a key that was not added being reported as seen, when a generation is full
+        """
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate / 2) / math.log(2)**2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+    def positions(self, key):
+        # double hashing: hash() is randomised per process, which is fine for a filter that is never saved
+        value = hash(key)
+        first = value & 0xffffffff
+        step = (value >> 32) & 0xffffffff | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key) -> bool:
+        """
+        :param key: any hashable value, e.g. (devID, epoch)
+        :return: True if the key was (probably) added before, False if it definitely was not. It is added either way
+        """
+        positions = self.positions(key)
+        current, previous = self.current, self.previous
+        if all(current[p >> 3] & (1 << (p & 7)) for p in positions) or \
+                all(previous[p >> 3] & (1 << (p & 7)) for p in positions):
+            return True
+        if self.count >= self.capacity:
+            self.previous, self.current = current, bytearray(len(current))
+            self.count = 0
+            current = self.current
+        for p in positions:
+            current[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        return False
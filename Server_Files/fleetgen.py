@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+import argparse, datetime, json, math, random, sys, time
+from gpscommon import dwell, geohash, topics
+from gpscommon.sampler import AdaptiveSampler
+
+"""Synthetic fleet of GPS devices, for load testing the server.
+
+Every simulated device produces the same payloads as Pi_Files/gpsdmqtt.py: "location" payloads with loc, meta.*, error.*,
+pos.* and time.* fields, and, when a device "loses its fix", "wifilocation" payloads carrying wifiAccessPoints in the
+format that wifi.Wifi.get_cells() returns. Payloads are serialised with str(), as the Pi does, so they go through
+Memory.verify() the same way.
+
+Devices alternate between moving and dwelling. While moving they either follow a random walk or, if a route file is
+given, travel along it; while dwelling they stay put apart from GPS noise, which is what Memory.geocode() needs to
+see to trigger its dwell/geocode path.
+
+With --pi, every device also does what the Pi does before publishing: its fixes go through an AdaptiveSampler, which
+holds back most fixes while it is stationary, and the ones sent are tagged with meta.suppressed, pos.geohash_int and
+the DwellDetector's meta.dwell, so the server takes the same shortcuts it takes for real devices.
+
+Examples:
+    # 2000 devices, one fix per second each, to a local broker on per-device topics
+    python3 fleetgen.py --devices 2000 --output mqtt://127.0.0.1:1883
+
+    # one simulated hour of 50 devices into a file, as fast as possible
+    python3 fleetgen.py --devices 50 --duration 3600 --no-realtime --output fixes.txt
+
+    # the same, sampled and tagged as gpsdmqtt.py does
+    python3 fleetgen.py --devices 50 --duration 3600 --no-realtime --pi --output fixes.txt
+"""
+
+EARTH_RADIUS = 6371000
+
+
+def offset(lat, lon, north, east):
+    """
+    Moves a point by a number of meters north and east. Accurate enough over the few meters travelled per fix.
+
+    :return: (lat, lon) of the moved point
+    """
+    lat2 = lat + math.degrees(north / EARTH_RADIUS)
+    lon2 = lon + math.degrees(east / (EARTH_RADIUS * math.cos(math.radians(lat))))
+    return lat2, lon2
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """
+    :return: initial bearing from the first point to the second, in degrees clockwise from north
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    y = math.sin(lon2 - lon1) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+class Device:
+    """
+    One simulated device. Call step() once per fix interval to move it and get the payload it would publish.
+    """
+    def __init__(self, dev_id, lat, lon, rng, route=None, mean_move=600, mean_dwell=900, mean_speed=12,
+                 noise=4, wifi_rate=0.01, pi=False):
+        """
+        :param dev_id: meta.devID of the device
+        :param lat: starting latitude
+        :param lon: starting longitude
+        :param rng: random.Random used for everything this device does
+        :param route: optional list of (lat, lon) waypoints to travel along, instead of a random walk. It needs at
+        least two different waypoints, or there would be nowhere to travel to
+        :param mean_move: mean time spent moving before a dwell, in seconds
+        :param mean_dwell: mean length of a dwell, in seconds
+        :param mean_speed: mean speed while moving, in meters per second
+        :param noise: standard deviation of the GPS noise, in meters
+        :param wifi_rate: probability that a fix is replaced by a wifilocation payload
+        :param pi: if True, sample and tag fixes as gpsdmqtt.py does, with an AdaptiveSampler and a DwellDetector
+        :raises ValueError: if the route has fewer than two different waypoints
+        """
+        if route is not None and len(set(tuple(point) for point in route)) < 2:
+            raise ValueError("a route needs at least two different waypoints, got " + str(route))
+        self.dev_id = dev_id
+        self.lat = lat
+        self.lon = lon
+        self.rng = rng
+        self.route = route
+        self.waypoint = 0
+        self.mean_move = mean_move
+        self.mean_dwell = mean_dwell
+        self.mean_speed = mean_speed
+        self.noise = noise
+        self.wifi_rate = wifi_rate
+        self.sampler = AdaptiveSampler() if pi else None
+        self.detector = dwell.DwellDetector() if pi else None
+        self.track = rng.uniform(0, 360)
+        self.speed = 0
+        self.alt = rng.uniform(0, 200)
+        self.moving = rng.random() < 0.5
+        self.state_left = rng.expovariate(1 / (mean_move if self.moving else mean_dwell))
+        self.access_points = [{'macAddress': ':'.join('%02x' % rng.randrange(256) for _ in range(6)),
+                               'channel': str(rng.choice((1, 6, 11, 36, 44))),
+                               'signalStrength': str(-rng.randrange(30, 90))} for _ in range(rng.randrange(2, 8))]
+
+    def move(self, dt):
+        """
+        Advances the true position of the device by dt seconds
+        """
+        self.state_left -= dt
+        if self.state_left <= 0:
+            self.moving = not self.moving
+            self.state_left = self.rng.expovariate(1 / (self.mean_move if self.moving else self.mean_dwell))
+        if not self.moving:
+            self.speed = 0
+            return
+
+        self.speed = max(0.5, self.rng.gauss(self.mean_speed, self.mean_speed / 4))
+        distance = self.speed * dt
+        if self.route:
+            while distance > 0:
+                target = self.route[self.waypoint]
+                remaining = geohash.haversine(self.lat, self.lon, target[0], target[1])
+                self.track = bearing(self.lat, self.lon, target[0], target[1])
+                if remaining > distance:
+                    break
+                self.lat, self.lon = target
+                distance -= remaining
+                self.waypoint = (self.waypoint + 1) % len(self.route)
+        else:
+            self.track = (self.track + self.rng.gauss(0, 15)) % 360
+        heading = math.radians(self.track)
+        self.lat, self.lon = offset(self.lat, self.lon, distance * math.cos(heading), distance * math.sin(heading))
+
+    def step(self, dt, epoch) -> dict:
+        """
+        Moves the device and builds the payload it publishes for this fix
+
+        :param dt: seconds since the previous fix
+        :param epoch: device time of this fix, used for meta.deviceepoch and time.*
+        :return: the payload, in the same schema as gpsdmqtt.py, or None if the device's sampler held the fix back
+        """
+        self.move(dt)
+        when = datetime.datetime.utcfromtimestamp(epoch)
+        if self.rng.random() < self.wifi_rate:
+            return {"wifiAccessPoints": self.access_points,
+                    "meta.deviceepoch": epoch,
+                    "meta.type": "wifilocation",
+                    "meta.devID": self.dev_id,
+                    "meta.weight": 0,
+                    "time.timezone": "UTC",
+                    "time.year": when.year,
+                    "time.month": when.month,
+                    "time.day": when.day,
+                    "time.hour": when.hour,
+                    "time.minute": when.minute,
+                    "time.second": when.second}
+
+        error_x = abs(self.rng.gauss(self.noise, self.noise / 2)) + 1
+        error_y = abs(self.rng.gauss(self.noise, self.noise / 2)) + 1
+        lat, lon = offset(self.lat, self.lon, self.rng.gauss(0, self.noise), self.rng.gauss(0, self.noise))
+        speed = max(0.0, self.speed + self.rng.gauss(0, 0.3))
+        self.alt += self.rng.gauss(0, 0.5)
+        if self.sampler is not None and not self.sampler.should_send(lat, lon, speed, self.track,
+                                                                     max(error_x, error_y), epoch):
+            return None
+        payload = {"loc": {
+                       "lat": round(lat, 7),
+                       "lon": round(lon, 7)
+                   },
+                   "meta.deviceepoch": epoch,
+                   "meta.type": "location",
+                   "meta.devID": self.dev_id,
+                   "meta.weight": 0,
+                   "error.climb": round(abs(self.rng.gauss(1, 0.5)), 3),
+                   "error.speed": round(abs(self.rng.gauss(0.5, 0.2)), 3),
+                   "error.altitude": round(error_y * 1.5, 3),
+                   "error.lat": round(error_y, 3),
+                   "error.lon": round(error_x, 3),
+                   "pos.alt": round(self.alt, 1),
+                   "pos.climb": round(self.rng.gauss(0, 0.2), 3),
+                   "pos.track": round(self.track, 1),
+                   "pos.speed": round(speed, 3),
+                   "time.timezone": "UTC",
+                   "time.year": when.year,
+                   "time.month": when.month,
+                   "time.day": when.day,
+                   "time.hour": when.hour,
+                   "time.minute": when.minute,
+                   "time.second": when.second}
+        if self.sampler is not None:
+            payload["meta.suppressed"] = self.sampler.take_suppressed()
+            payload["pos.geohash_int"] = geohash.geohash_int(payload["loc"]["lat"], payload["loc"]["lon"], 40)
+            payload["meta.dwell"] = self.detector.update(payload)
+        return payload
+
+
+class Fleet:
+    """
+    A set of Devices spread around a centre point, stepped together once per interval.
+    """
+    def __init__(self, count, lat=39.1854, lon=-76.8508, spread=20000, seed=None, routes=None, prefix='sim_', **kwargs):
+        """
+        :param count: number of devices
+        :param lat: latitude the fleet is centred on
+        :param lon: longitude the fleet is centred on
+        :param spread: devices start within this many meters of the centre
+        :param seed: seed for the random number generator, for repeatable runs
+        :param routes: optional list of routes (lists of (lat, lon)). Devices are assigned to them round robin, and
+        start at a random waypoint
+        :param prefix: prefix of the device ids
+        :param kwargs: passed on to Device
+        """
+        rng = random.Random(seed)
+        self.devices = []
+        for i in range(count):
+            route = None
+            if routes:
+                route = routes[i % len(routes)]
+                start = rng.randrange(len(route))
+                dlat, dlon = route[start]
+            else:
+                dlat, dlon = offset(lat, lon, rng.uniform(-spread, spread), rng.uniform(-spread, spread))
+            device = Device(prefix + str(i), dlat, dlon, random.Random(rng.random()), route=route, **kwargs)
+            if route:
+                device.waypoint = (start + 1) % len(route)
+            self.devices.append(device)
+
+    def tick(self, dt, epoch):
+        """
+        :return: generator of the payloads every device publishes at the given epoch
+        """
+        for device in self.devices:
+            payload = device.step(dt, epoch)
+            if payload is not None:
+                yield payload
+
+
+class FileSink:
+    """
+    Writes one payload per line, in the same str() form the Pi publishes
+    """
+    def __init__(self, path):
+        self.file = sys.stdout if path == '-' else open(path, 'w')
+
+    def send(self, payload):
+        self.file.write(str(payload) + '\n')
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class MqttSink:
+    """
+    Publishes payloads to a broker, either to one topic or to each device's own topic (<topic>/<bucket>/<devID>, see
+    gpscommon.topics)
+    """
+    def __init__(self, host, port, topic, per_device=True, qos=0, username=None, password=None):
+        import paho.mqtt.client as mqtt
+        self.topic = topic
+        self.per_device = per_device
+        self.qos = qos
+        self.client = mqtt.Client('fleetgen-' + str(random.randrange(1 << 30)))
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def send(self, payload):
+        topic = topics.device_topic(self.topic, payload['meta.devID']) if self.per_device else self.topic
+        self.client.publish(topic=topic, payload=str(payload), qos=self.qos)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run(fleet, sink, interval=1.0, duration=None, rate=None, realtime=True, start=None, report=10):
+    """
+    Steps the fleet and sends every payload to the sink.
+
+    :param fleet: the Fleet to simulate
+    :param sink: FileSink or MqttSink
+    :param interval: simulated seconds between fixes of one device
+    :param duration: simulated seconds to run for. Runs until interrupted if None
+    :param rate: optional cap on messages sent per (real) second
+    :param realtime: if True, wait out each interval so devices publish at their real rate. If False, produce data
+    as fast as possible (or as fast as rate allows) with simulated timestamps
+    :param start: epoch of the first fix. Defaults to now
+    :param report: print throughput every this many seconds of real time
+    :return: number of payloads sent
+    """
+    epoch = time.time() if start is None else start
+    end = None if duration is None else epoch + duration
+    sent = 0
+    began = last_report = time.time()
+    reported = 0
+    while end is None or epoch < end:
+        tick_started = time.time()
+        for payload in fleet.tick(interval, epoch):
+            sink.send(payload)
+            sent += 1
+            if rate:
+                ahead = began + sent / rate - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+        epoch += interval
+        now = time.time()
+        if realtime:
+            time.sleep(max(0, interval - (now - tick_started)))
+        if now - last_report >= report:
+            print("SENT::: " + str(sent) + " payloads, " + str(round((sent - reported) / (now - last_report))) + "/s",
+                  file=sys.stderr)
+            last_report, reported = now, sent
+    return sent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a fleet of gpsdmqtt.py devices")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between fixes of one device")
+    parser.add_argument('--duration', type=float, default=None, help="simulated seconds to run for")
+    parser.add_argument('--rate', type=float, default=None, help="maximum messages per second")
+    parser.add_argument('--no-realtime', dest='realtime', action='store_false',
+                        help="don't wait between intervals, just generate timestamps")
+    parser.add_argument('--output', default='-', help="mqtt://host:port, a file path, or - for stdout")
+    parser.add_argument('--topic', default='gpsd_location')
+    parser.add_argument('--shared-topic', action='store_true',
+                        help="publish every device to --topic instead of <topic>/<devID>")
+    parser.add_argument('--qos', type=int, default=0)
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--routes', help="JSON file holding a list of routes, each a list of [lat, lon] waypoints")
+    parser.add_argument('--lat', type=float, default=39.1854)
+    parser.add_argument('--lon', type=float, default=-76.8508)
+    parser.add_argument('--spread', type=float, default=20000, help="meters around lat/lon to start devices in")
+    parser.add_argument('--mean-move', type=float, default=600)
+    parser.add_argument('--mean-dwell', type=float, default=900)
+    parser.add_argument('--noise', type=float, default=4, help="GPS noise, in meters")
+    parser.add_argument('--wifi-rate', type=float, default=0.01, help="fraction of fixes sent as wifilocation")
+    parser.add_argument('--pi', action='store_true',
+                        help="sample fixes and tag them with meta.suppressed, pos.geohash_int and meta.dwell as the "
+                             "Pi does")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    routes = None
+    if args.routes:
+        with open(args.routes) as file:
+            routes = [[tuple(point) for point in route] for route in json.load(file)]
+        if not all(len(set(route)) >= 2 for route in routes):
+            parser.error("every route in " + args.routes + " needs at least two different waypoints")
+    fleet = Fleet(args.devices, lat=args.lat, lon=args.lon, spread=args.spread, seed=args.seed, routes=routes,
+                  mean_move=args.mean_move, mean_dwell=args.mean_dwell, noise=args.noise, wifi_rate=args.wifi_rate,
+                  pi=args.pi)
+
+    if args.output.startswith('mqtt://'):
+        host, _, port = args.output[len('mqtt://'):].partition(':')
+        sink = MqttSink(host, int(port or 1883), args.topic, per_device=not args.shared_topic, qos=args.qos,
+                        username=args.username, password=args.password)
+    else:
+        sink = FileSink(args.output)
+    try:
+        run(fleet, sink, interval=args.interval, duration=args.duration, rate=args.rate, realtime=args.realtime)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python3
+import json, math, queue, sys, threading, time
+from gpscommon import geohash
+
+"""Map matching, i.e. snapping moving location points to the road the device is most likely on.
+
+The road network is read from a local GeoJSON file of LineString (or MultiLineString) features, each with an "id"
+(taken from the feature's properties, or the feature itself). Every straight piece of road is stored in the geohash
+cells it passes through (RoadNetwork), so the candidate roads for a fix are found by looking in a few cells.
+
+Matching is done with a simplified version of the hidden Markov model of Newson and Krumm (2009): the hidden states are
+the candidate points on nearby roads, a fix is more likely to come from a road the closer it is (emission), and a move
+between two candidates is more likely the closer its length is to the distance between the two fixes (transition).
+Newson and Krumm measure that move along the road network, by the shortest route between the two candidates; here it is
+the straight line between them, with a fixed penalty when their roads do not meet. That needs no route search per pair
+of candidates, and at one fix a second the two lengths differ little except around corners, which is what the penalty is
+for, but a detour (a cloverleaf, or a parallel road across a barrier) looks as short as the road it leaves. See
+bench_mapmatch.py for how well it does on a grid of roads. Matcher runs the Viterbi algorithm over a fixed-length
+window, so every fix is decided after `lag` more fixes have been seen and the work per fix stays constant no matter how
+long the device keeps moving.
+"""
+
+METERS_PER_DEGREE = 111319.5
+
+
+class RoadNetwork:
+    """
+    Road segments, bucketed by the geohash cell (of bin_precision bits) they pass through
+    """
+    def __init__(self, bin_precision=30):
+        self.bin_precision = bin_precision
+        self.height = 180 / 2**(bin_precision // 2)
+        self.width = 360 / 2**((bin_precision + 1) // 2)
+        self.segments = []
+        self.buckets = {}
+        self.nodes = {}
+
+    @classmethod
+    def load(cls, path, bin_precision=30):
+        """
+        :param path: path to a GeoJSON FeatureCollection of roads
+        :param bin_precision: size of the index cells, in geohash bits
+        :return: the RoadNetwork
+        """
+        network = cls(bin_precision)
+        with open(path) as file:
+            collection = json.load(file)
+        for number, feature in enumerate(collection['features']):
+            geometry = feature['geometry']
+            road_id = str((feature.get('properties') or {}).get('id', feature.get('id', number)))
+            lines = [geometry['coordinates']] if geometry['type'] == 'LineString' else geometry['coordinates']
+            for line in lines:
+                network.add_road(road_id, [(lat, lon) for lon, lat in (point[:2] for point in line)])
+        return network
+
+    def key(self, row, col):
+        """
+        :return: the bucket key (the integer geohash) of the cell in the given row and column of the grid
+        """
+        return geohash.geohash_int((row + 0.5) * self.height - 90, (col + 0.5) * self.width - 180, self.bin_precision)
+
+    def keys(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        :return: generator of the bucket keys of every cell overlapping the box
+        """
+        for row in range(math.floor((min_lat + 90) / self.height), math.floor((max_lat + 90) / self.height) + 1):
+            for col in range(math.floor((min_lon + 180) / self.width), math.floor((max_lon + 180) / self.width) + 1):
+                yield self.key(row, col)
+
+    def add_road(self, road_id, points):
+        """
+        :param road_id: id of the road
+        :param points: list of (lat, lon) along the road
+        :return: None
+        """
+        for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+            index = len(self.segments)
+            self.segments.append((road_id, lat1, lon1, lat2, lon2))
+            for node in ((lat1, lon1), (lat2, lon2)):
+                self.nodes.setdefault(node, set()).add(road_id)
+            for key in self.keys(min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)):
+                self.buckets.setdefault(key, []).append(index)
+
+    def connected(self, index1, index2):
+        """
+        :return: True if the two segments are on the same road, or on roads that meet at an end of either segment
+        """
+        road1, lat1, lon1, lat2, lon2 = self.segments[index1]
+        road2 = self.segments[index2][0]
+        if road1 == road2:
+            return True
+        return road2 in self.nodes[(lat1, lon1)] or road2 in self.nodes[(lat2, lon2)]
+
+    def candidates(self, lat, lon, radius):
+        """
+        Finds the closest point on every segment within radius meters of a fix
+
+        :return: list of (distance, segment index, lat, lon) of the closest points, nearest first
+        """
+        dlat = radius / METERS_PER_DEGREE
+        cos_lat = math.cos(math.radians(lat))
+        dlon = dlat / max(cos_lat, 1e-6)
+        seen = set()
+        result = []
+        for key in self.keys(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+            for index in self.buckets.get(key, ()):
+                if index in seen:
+                    continue
+                seen.add(index)
+                road_id, lat1, lon1, lat2, lon2 = self.segments[index]
+                # project onto the segment in a local flat frame centred on the fix, in meters
+                x1, y1 = (lon1 - lon) * cos_lat, lat1 - lat
+                x2, y2 = (lon2 - lon) * cos_lat, lat2 - lat
+                dx, dy = x2 - x1, y2 - y1
+                length = dx * dx + dy * dy
+                fraction = 0 if length == 0 else min(1, max(0, -(x1 * dx + y1 * dy) / length))
+                x, y = x1 + fraction * dx, y1 + fraction * dy
+                distance = math.sqrt(x * x + y * y) * METERS_PER_DEGREE
+                if distance <= radius:
+                    result.append((distance, index, lat + y, lon + x / cos_lat))
+        result.sort()
+        return result
+
+
+class Matcher:
+    """
+    Incremental, fixed-lag Viterbi matcher for the fixes of one device.
+
+    Call push() with every moving fix, in time order. It returns the fixes that have been decided, annotated with
+    road.id, road.loc and road.distance. Call flush() when the device stops, to decide the ones still in the window.
+    """
+    def __init__(self, network, radius=50, sigma=5, beta=10, lag=8, max_candidates=8, turn_penalty=2.0):
+        """
+        :param network: the RoadNetwork
+        :param radius: how far from a fix to look for roads, in meters
+        :param sigma: smallest GPS error to assume, in meters. The fix's own error is used when it is larger
+        :param beta: scale of the transition probability, in meters
+        :param lag: number of fixes kept before the oldest one is decided
+        :param max_candidates: most candidate roads kept per fix
+        :param turn_penalty: log probability subtracted when moving between roads that are not connected
+        """
+        self.network = network
+        self.radius = radius
+        self.sigma = sigma
+        self.beta = beta
+        self.lag = lag
+        self.max_candidates = max_candidates
+        self.turn_penalty = turn_penalty
+        self.window = []
+        self.last_seen = 0
+
+    def push(self, payload) -> list:
+        """
+        :param payload: a moving location payload
+        :return: list of payloads that are now decided, oldest first
+        """
+        self.last_seen = time.time()
+        lat, lon = payload["loc"]["lat"], payload["loc"]["lon"]
+        candidates = self.network.candidates(lat, lon, self.radius)[:self.max_candidates]
+        if not candidates:
+            return self.flush() + [payload]
+
+        sigma = max(self.sigma, payload.get("error.lat", 0), payload.get("error.lon", 0))
+        emissions = [-0.5 * (distance / sigma)**2 for distance, _, _, _ in candidates]
+        if not self.window:
+            self.window.append((payload, candidates, emissions, [None] * len(candidates)))
+            return []
+
+        previous_payload, previous, previous_scores, _ = self.window[-1]
+        straight = geohash.haversine(previous_payload["loc"]["lat"], previous_payload["loc"]["lon"], lat, lon)
+        scores = []
+        back = []
+        for emission, (_, index, clat, clon) in zip(emissions, candidates):
+            best, best_from = -math.inf, 0
+            for j, (_, pindex, plat, plon) in enumerate(previous):
+                # straight line between the candidates, not the route along the roads (see the module docstring)
+                moved = geohash.haversine(plat, plon, clat, clon)
+                score = previous_scores[j] - abs(moved - straight) / self.beta
+                if not self.network.connected(pindex, index):
+                    score -= self.turn_penalty
+                if score > best:
+                    best, best_from = score, j
+            scores.append(best + emission)
+            back.append(best_from)
+        top = max(scores)
+        scores = [score - top for score in scores]
+        self.window.append((payload, candidates, scores, back))
+
+        if len(self.window) > self.lag:
+            return [self.decide(1)[0]]
+        return []
+
+    def decide(self, count) -> list:
+        """
+        Backtracks from the best state of the newest fix, and removes the oldest count fixes from the window,
+        annotated with the road they were matched to
+
+        :return: list of the decided payloads
+        """
+        scores = self.window[-1][2]
+        state = max(range(len(scores)), key=scores.__getitem__)
+        path = [state]
+        for _, _, _, back in reversed(self.window[1:]):
+            state = back[state]
+            path.append(state)
+        path.reverse()
+
+        decided = []
+        for (payload, candidates, _, _), state in zip(self.window[:count], path):
+            distance, index, lat, lon = candidates[state]
+            payload["road.id"] = self.network.segments[index][0]
+            payload["road.loc"] = {"lat": lat, "lon": lon}
+            payload["road.distance"] = distance
+            decided.append(payload)
+        del self.window[:count]
+        if self.window:
+            # the new oldest fix has nothing before it any more
+            payload, candidates, scores, back = self.window[0]
+            self.window[0] = (payload, candidates, scores, [None] * len(candidates))
+        return decided
+
+    def flush(self) -> list:
+        """
+        :return: every payload still in the window, decided
+        """
+        if not self.window:
+            return []
+        return self.decide(len(self.window))
+
+
+class Snapper(threading.Thread):
+    """
+    Separate thread of control for map matching. Takes moving payloads from snap_queue, runs them through a Matcher
+    per device, and puts the annotated payloads on the upload queue. A device that sends nothing for idle seconds has
+    its window flushed and its Matcher dropped, so its last fixes are not held back forever. Every window is flushed
+    when the thread is stopped.
+
+    If the road network cannot be loaded, that is logged and payloads are passed on to the upload queue unsnapped.
+    """
+    def __init__(self, snap_queue, upl_queue, config, log_queue, idle=10):
+        threading.Thread.__init__(self, name="Snapper")
+        self.__stop = False
+        self.snap_queue = snap_queue
+        self.upl_queue = upl_queue
+        self.config = config
+        self.log_queue = log_queue
+        self.idle = idle
+        self.network = None
+        self.matchers = {}
+        self.daemon = True
+
+    def run(self):
+        try:
+            self.network = RoadNetwork.load(self.config.road_network)
+        except:
+            self.log_queue.put(("Snapper", "Error: could not load the road network, not snapping: " +
+                                str(sys.exc_info())))
+        checked = time.time()
+        while 1:
+            try:
+                if self.__stop:
+                    self.flush_all()
+                    return 0
+                if time.time() - checked > 1:
+                    self.flush_idle()
+                    checked = time.time()
+                try:
+                    payload = self.snap_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if self.network is None:
+                    self.upl_queue.put(payload)
+                    continue
+                matcher = self.matchers.get(payload["meta.devID"])
+                if matcher is None:
+                    matcher = self.matchers[payload["meta.devID"]] = Matcher(self.network)
+                for decided in matcher.push(payload):
+                    self.upl_queue.put(decided)
+            except:
+                self.log_queue.put(("Snapper", "Error: " + str(sys.exc_info())))
+
+    def flush_idle(self):
+        now = time.time()
+        for dev_id, matcher in list(self.matchers.items()):
+            if now - matcher.last_seen > self.idle:
+                for decided in matcher.flush():
+                    self.upl_queue.put(decided)
+                del self.matchers[dev_id]
+
+    def flush_all(self):
+        """
+        Decides every fix still in a window, and puts it on the upload queue
+        :return: None
+        """
+        for matcher in self.matchers.values():
+            for decided in matcher.flush():
+                self.upl_queue.put(decided)
+        self.matchers = {}
+
+    def stop_thread(self):
+        """
+        Should not be called unless self.queue is empty
+        :return: None
+        """
+        self.__stop = True
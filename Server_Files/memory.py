@@ -1,8 +1,7 @@
 #!/usr/bin/python3
-import json, sys, queue, threading, time, requests
-from asyncio import Lock
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-import geohash
+import json, math, sys, queue, threading, time
+import dedup
+from gpscommon import geohash, dwell
 
 
 class Memory:
@@ -30,34 +29,70 @@ class Memory:
      thread. This thread will request the geocoded location from google maps, fill the information into the payload, then
      pass it back to be uploaded to Elasticsearch.
 
-     The possibility also exists for road mapping, i.e. snapping location points to the closest road that the pattern follows
-     in google maps.
+     Moving locations can also be snapped to the closest road that the pattern follows (see the mapmatch module), if a road
+     network file is configured.
+
+     Messages can arrive twice, or out of order, so the mqtt client hands them to receive(), which drops duplicates and
+     passes each device's fixes on to geocode() in time order (see the dedup module). tick() has to be called about once
+     a second, to release fixes from devices that have stopped sending.
+
+     None of the worker threads are started here. Each one is attached to the queue it reads from, and is started the
+     first time something is put on that queue (see ConsumerQueue), so a freshly started server does no network or file
+     work until the first message arrives.
     """
-    def __init__(self, api_key, aws_auth):
+    def __init__(self, config):
         self.first = MemoryBranch()
 
         self.decoder = json.JSONDecoder()
 
-        self.last_payload = None
-        self.weight = 0
-        self.recode = True
-        # self.lock = Lock()
-
-        self.log_queue = queue.Queue()
-        self.log = Log(self.log_queue)
-        self.log.start()
-
-        self.upl_queue = queue.Queue()
-        self.uploader = Uploader("Uploader", self.upl_queue, aws_auth, self.log_queue)
-        self.uploader.start()
-
-        self.geo_queue = queue.Queue()
-        self.geocoder = Geocoder("Geocoder", self.geo_queue, self.upl_queue, api_key, self.log_queue)
-        self.geocoder.start()
-
-        self.glo_queue = queue.Queue()
-        self.geolocator = Geolocator(self, api_key, self.glo_queue, self.log_queue)
-        self.geolocator.start()
+        self.config = config
+        self.devices = {}
+        # receive(), tick() and the Geolocator all call geocode(), from different threads
+        self.lock = threading.Lock()
+        self.seen = dedup.RollingBloom(config.dedup_capacity)
+        self.pending = set()
+
+        self.log_queue = ConsumerQueue()
+        self.log = self.log_queue.attach(Log(self.log_queue, config.log_file))
+
+        self.upl_queue = ConsumerQueue()
+        self.uploader = self.upl_queue.attach(Uploader("Uploader", self.upl_queue, config, self.log_queue))
+
+        self.geo_queue = ConsumerQueue()
+        self.geocoder = self.geo_queue.attach(Geocoder("Geocoder", self.geo_queue, self.upl_queue, config, self.log_queue))
+
+        self.glo_queue = ConsumerQueue()
+        self.geolocator = self.glo_queue.attach(Geolocator(self, config, self.glo_queue, self.log_queue))
+
+        # moving locations go through the road snapper on their way to the uploader, if there is a road network
+        self.snapper = None
+        self.mov_queue = self.upl_queue
+        if config.road_network:
+            import mapmatch
+            self.mov_queue = ConsumerQueue()
+            self.snapper = self.mov_queue.attach(mapmatch.Snapper(self.mov_queue, self.upl_queue, config, self.log_queue))
+
+        # per device daily totals, uploaded as summary documents every config.summary_interval seconds. The totals
+        # stored by an earlier run are looked up by a thread of their own, off the message path
+        self.aggregator = None
+        self.sum_queue = None
+        if config.summary_interval:
+            import aggregate
+            self.sum_queue = ConsumerQueue()
+            self.aggregator = aggregate.Aggregator(self.upl_queue, config.summary_interval, self.sum_queue)
+            self.sum_queue.attach(aggregate.SummaryLoader(self.sum_queue, self.aggregator.loaded, self.uploader.stored,
+                                                          self.log_queue))
+
+        # time spent in each stage, logged by tick() every config.stats_interval seconds (see profiling.StageTimers)
+        self.timers = None
+        self.reported = time.time()
+        if config.stage_timers:
+            import profiling
+            self.timers = profiling.StageTimers()
+            self.verify = self.timers.wrap("verify", self.verify)
+            self.geocode = self.timers.wrap("geocode", self.geocode)
+            self.searchelseinsert = self.timers.wrap("searchelseinsert", self.searchelseinsert)
+            self.uploader.upload_batch = self.timers.wrap("upload_batch", self.uploader.upload_batch)
 
     def verify(self, msg_payload) -> dict:
         """
@@ -76,6 +111,74 @@ class Memory:
                 payload = self.decoder.decode('{\"error\": \"message not able to be parsed\"}')
         return payload
 
+    def device(self, dev_id) -> 'DeviceState':
+        """
+        :param dev_id: the meta.devID of a payload
+        :return: the DeviceState kept for that device, created if this is the first payload seen from it
+        """
+        state = self.devices.get(dev_id)
+        if state is None:
+            state = self.devices[dev_id] = DeviceState(self.config.reorder_window, self.config.reorder_size,
+                                                       self.config.reorder_reset)
+        return state
+
+    def receive(self, payload: dict) -> bool:
+        """
+        Called by the mqtt client for every verified payload. Wifi location payloads go to geolocate() unless they have
+        been seen before. GPS fixes go through their device's ReorderBuffer, and the ones it releases to geocode().
+
+        :param payload: the payload, with meta.messageepoch set
+        :return: False if the payload was dropped as a duplicate or as too late, True otherwise
+        """
+        with self.lock:
+            if payload["meta.type"] == "wifilocation":
+                if self.seen.add((payload["meta.devID"], payload["meta.deviceepoch"])):
+                    return False
+                self.geolocate(payload)
+                return True
+            state = self.device(payload["meta.devID"])
+            dropped, resets, released = state.reorder.dropped, state.reorder.resets, state.reorder.released
+            for fix in state.reorder.push(payload, payload["meta.messageepoch"]):
+                self.geocode(fix)
+            if state.reorder.resets != resets:
+                self.log_queue.put((payload["meta.devID"], "clock set back: fix at " +
+                                    str(payload["meta.deviceepoch"]) + " is " +
+                                    str(round(released - payload["meta.deviceepoch"])) +
+                                    "s older than the last one processed, starting again from it"))
+            if state.reorder:
+                self.pending.add(payload["meta.devID"])
+            else:
+                self.pending.discard(payload["meta.devID"])
+            return state.reorder.dropped == dropped
+
+    def tick(self):
+        """
+        Geocodes the fixes that have waited in a reorder buffer for longer than config.reorder_window seconds, and logs
+        the stage timers when they are due
+        :return: None
+        """
+        now = time.time()
+        self.release(now)
+        if self.timers is not None and now - self.reported >= self.config.stats_interval:
+            self.reported = now
+            report = self.timers.report()
+            if report:
+                self.log_queue.put(("Timers", report))
+
+    def release(self, now):
+        """
+        Geocodes the fixes that have been held in a reorder buffer since before now - config.reorder_window
+        :param now: the current time, or math.inf to release every fix held
+        :return: None
+        """
+        with self.lock:
+            for dev_id in list(self.pending):
+                reorder = self.devices[dev_id].reorder
+                for fix in reorder.release_due(now):
+                    self.geocode(fix)
+                if not reorder:
+                    self.pending.discard(dev_id)
+
     def geolocate(self, payload: dict):
         """
         Called if the payload is of type wifilocation, tells geocoder to send geolocation data and receive a location
@@ -90,70 +193,61 @@ class Memory:
         """
         Method called by outside functions. Highest level method of Memory class
 
-        First checks if the user is in approximately the same location (+- 50m) as self.last_payload. If they are not,
-        the old value of self.last_payload is replaces with the current payload. If they are, then it checks if they
-        have been in that location for more than 3 minutes. If they have not, it moves on. If they have, it runs
-        search_else_insert() on the payload.
+        All of the state below is kept per device (see DeviceState), keyed on meta.devID.
+
+        First checks if the user is in approximately the same location (+- 50m) as the device's anchor fix (see
+        gpscommon.dwell.DwellDetector). If they are not, the anchor is replaced with the current payload. If they are,
+        then it checks if they have been in that location for more than 3 minutes. If they have not, it moves on. If
+        they have, it runs search_else_insert() on the payload. Payloads from a Pi that already ran the check carry its
+        result in meta.dwell (and a precomputed geohash in pos.geohash_int), and are not checked again, as long as the
+        device's anchor here is also one of those payloads.
 
         After that, it checks for the speed of the user. If the user's speed is > 2 km/h, it uploads the location,
         otherwise it adds 0.0167 to the weight of the next location sent, and keeps doing so until the user is once
-        again moving at > 2 km/h
+        again moving at > 2 km/h. Fixes the device did not send (counted in meta.suppressed) add 0.0167 each as well.
+        Moving locations are snapped to the nearest road first, if config.road_network is set. Every payload is also
+        added to the device's daily totals (see aggregate.Aggregator)
 
         :param payload: payload to geocode
         :return: True if it's geocoding, false otherwise
         """
-        # print("trying for lock")
-        # yield from self.lock
-        # print("got lock")
-        try:
-            if self.last_payload is None:
-                self.last_payload = payload
-            payload['meta.weight'] = self.weight
-            geo_hash, lat_error, lon_error = geohash.geohash(payload["loc"]["lat"], payload["loc"]["lon"], 35)
-            avg_error = (payload["error.lat"] + payload["error.lon"] + self.last_payload["error.lat"] + self.last_payload["error.lon"]) / 4
-
-            # print(geohash.haversine(payload["loc"]["lat"], payload["loc"]["lon"], self.last_payload["loc"]["lat"],
-            #                         self.last_payload["loc"]["lon"]))
-            if geohash.haversine(payload["loc"]["lat"], payload["loc"]["lon"], self.last_payload["loc"]["lat"], self.last_payload["loc"]["lon"]) < 30 + avg_error:
-                # print("is less than " + str(50 + avg_error))
-                if abs(payload["meta.deviceepoch"] - self.last_payload["meta.deviceepoch"]) > 180:
-                    if self.searchelseinsert(geo_hash, payload):
-                        self.last_payload = payload
-                        self.recode = False
-                        return True
-                    self.last_payload = payload
-                elif payload["pos.speed"] > 2:
-                    # print("speed > 2")
-                    self.weight = 0
-                    self.upl_queue.put(payload)
-                    self.last_payload = payload
-                    # print('uploaded: ' + str(payload))
-                elif payload['meta.type'] == 'wifilocation':
-                    self.weight += 0.167
-                else:
-                    self.weight += 0.0167
-                return False
-
-            if payload["pos.speed"] > 2:
-                # print("speed > 2")
-                self.weight = 0
-                self.upl_queue.put(self.last_payload)
-                self.last_payload = payload
-                # print('uploaded: ' + str(payload))
-            else:
-                if payload['meta.type'] == 'wifilocation':
-                    self.weight += 0.167
-                else:
-                    self.weight += 0.0167
-                # print('weight is: ' + str(self.weight))
-            self.recode = True
+        state = self.device(payload["meta.devID"])
+        # fixes the device's sampler skipped all count as time spent in place
+        state.weight += 0.0167 * payload.get('meta.suppressed', 0)
+        payload['meta.weight'] = state.weight
+
+        # the Pi runs the same DwellDetector on what it sends, so its answer can be used as is, but only while the anchor
+        # here is one the Pi chose too. Once a geolocated wifi fix has moved it, the two no longer agree
+        kind = payload.get('meta.dwell')
+        anchor = state.detector.anchor
+        if kind is None or anchor is not None and ('meta.dwell' not in anchor or anchor['meta.type'] == 'wifilocation'):
+            kind = state.detector.classify(payload)
+        anchor = state.detector.advance(payload, kind)
+        if self.aggregator is not None:
+            self.aggregator.update(payload, kind)
+
+        if kind == dwell.DWELL:
+            if self.searchelseinsert(dwell.cell(payload), payload, recode=state.recode):
+                state.recode = False
+                return True
             return False
-        finally:
-            pass
-            # print("released lock")
-            # self.lock.release()
 
-    def searchelseinsert(self, geo_hash: str, payload: dict, precision: int=None):
+        if kind == dwell.MOVE:
+            state.weight = 0
+            self.mov_queue.put(payload)
+        elif kind == dwell.LEAVE:
+            # the location uploaded is the one the user is leaving
+            state.weight = 0
+            self.mov_queue.put(anchor)
+        elif payload['meta.type'] == 'wifilocation':
+            state.weight += 0.167
+        else:
+            state.weight += 0.0167
+        if kind in (dwell.LEAVE, dwell.AWAY):
+            state.recode = True
+        return False
+
+    def searchelseinsert(self, geo_hash: str, payload: dict, precision: int=None, recode: bool=True):
         """
         Searches for specified geo_hash to a given precision, inserts it if it doesnt find it.
 
@@ -163,6 +257,7 @@ class Memory:
         :param geo_hash: geohash to search for
         :param payload: payload to insert if geohash is not found
         :param precision: optional precision to search to. Defaults to length of geohash given
+        :param recode: whether a stored location should be uploaded again when found (the device's recode flag)
         :return: False if geohash is found to the specified precision, True if it is inserting it
         """
         current = self.first
@@ -184,7 +279,7 @@ class Memory:
                 return True
 
         if level == precision and current.children[0].is_leaf:
-            if self.recode:
+            if recode:
                 for key, value in dict(current.children[0].value).items():
                     if key.startswith('geo.'):
                         payload[key] = value
@@ -219,28 +314,92 @@ class Memory:
         """
         self.stop_threads()
 
-        self.geocoder.join()
-
     def wait_for(self, thing):
         while thing in self.geo_queue:
             time.sleep(0.1)
 
     def stop_threads(self):
         """
-        Waits for self.queue to empty out, then calls for the thread to stop.
+        Stops the worker threads one queue at a time, each after it has emptied its queue, in the order the payloads
+        flow through them. Threads that were never started, or have died, are skipped (see ConsumerQueue.stop()). The
+        fixes still held in reorder buffers are geocoded first. Nothing should call receive() once this has started.
         :return: None
         """
-        while not self.geo_queue.empty():
-            time.sleep(0.1)
-        self.geocoder.__stop = True
+        self.release(math.inf)
+        self.glo_queue.stop()
+        if self.aggregator is not None:
+            self.sum_queue.stop()
+            with self.lock:
+                self.aggregator.flush()
+                if self.aggregator.waiting:
+                    self.log_queue.put(("Aggregator", "not uploading " + str(len(self.aggregator.waiting)) +
+                                        " summaries, the totals stored for them could not be loaded\n"))
+        self.geo_queue.stop()
+        if self.snapper is not None:
+            # the Snapper flushes its windows when it stops. If it died, whatever it had not taken is uploaded unsnapped
+            self.mov_queue.stop()
+            while not self.mov_queue.empty():
+                self.upl_queue.put(self.mov_queue.get_nowait())
+        self.upl_queue.stop()
+        self.log_queue.stop()
+
+
+class DeviceState:
+    """
+    The part of Memory that belongs to a single device: the buffer that puts its fixes back in order, the dwell detector
+    holding the payload the dwell check compares against, the weight given to the next upload, and whether a dwell
+    location found in the tree should be uploaded again.
+    """
+    def __init__(self, reorder_window=5, reorder_size=64, reorder_reset=600):
+        self.reorder = dedup.ReorderBuffer(reorder_window, reorder_size, reorder_reset)
+        self.detector = dwell.DwellDetector()
+        self.weight = 0
+        self.recode = True
 
-        while not self.upl_queue.empty():
-            time.sleep(0.1)
-        self.uploader.__stop = True
 
-        while not self.log_queue.empty():
+class ConsumerQueue(queue.Queue):
+    """
+    Queue that starts the thread consuming it the first time an item is put on it.
+
+    This keeps Memory cheap to create: the Uploader, Geocoder, Geolocator and Log threads (and the clients they build)
+    only come to life once there is work for them.
+    """
+    def __init__(self, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.consumer = None
+        self.start_lock = threading.Lock()
+
+    def attach(self, consumer: threading.Thread) -> threading.Thread:
+        """
+        :param consumer: thread that reads from this queue, not yet started
+        :return: the same thread
+        """
+        self.consumer = consumer
+        return consumer
+
+    def put(self, item, block=True, timeout=None):
+        # the item goes in first: consumers that find their queue empty sleep before looking again
+        queue.Queue.put(self, item, block, timeout)
+        if self.consumer is not None and self.consumer.ident is None:
+            with self.start_lock:
+                if self.consumer.ident is None:
+                    self.consumer.start()
+
+    def stop(self, timeout=30):
+        """
+        Waits for the consumer to empty the queue and finish what it is working on, then stops it. Does not wait if the
+        consumer was never started or has died, since nothing would ever empty the queue then.
+
+        :param timeout: longest time to wait for the consumer to finish its last item, in seconds
+        :return: None
+        """
+        consumer = self.consumer
+        if consumer is None or not consumer.is_alive():
+            return
+        while not self.empty() and consumer.is_alive():
             time.sleep(0.1)
-        self.log.__stop = True
+        consumer.stop_thread()
+        consumer.join(timeout)
 
 
 class MemoryNode:
@@ -303,13 +462,14 @@ class Geocoder(threading.Thread):
     Geocoding takes a large amount of time compared to everything else, so putting it in a separate thread of control
     allows it to be performed while the program runs other things.
     """
-    def __init__(self, name, geo_queue, upl_queue, api_key, log_queue):
+    def __init__(self, name, geo_queue, upl_queue, config, log_queue):
         threading.Thread.__init__(self, name=name)
         self.__stop = False
         self.geo_queue = geo_queue
         self.upl_queue = upl_queue
         self.decoder = json.JSONDecoder()
-        self.api_key = api_key
+        self.config = config
+        self.api_key = None
         self.log_queue = log_queue
         self.daemon = True
 
@@ -322,6 +482,10 @@ class Geocoder(threading.Thread):
                     time.sleep(0.01)
                     continue
                 payload = self.geo_queue.get()
+                # read here so that a missing key file is logged, and the queue still drained, instead of killing the thread
+                import requests
+                if self.api_key is None:
+                    self.api_key = self.config.google_api_key
                 response = requests.get("https://maps.googleapis.com/maps/api/geocode/json?latlng=" +
                                     str(payload["loc"]["lat"]) + ',' + str(payload["loc"]["lon"]) + "&key=" + self.api_key)
                 location = response.json()['results'][0]
@@ -344,14 +508,15 @@ class Geocoder(threading.Thread):
 
 
 class Geolocator(threading.Thread):
-    def __init__(self, memory, api_key, glo_queue: queue.Queue, log_queue: queue.Queue):
+    def __init__(self, memory, config, glo_queue: queue.Queue, log_queue: queue.Queue):
         threading.Thread.__init__(self, name="Geolocator")
         self.memory = memory
         self.glo_queue = glo_queue
         self.log_queue = log_queue
-        self.api_key = api_key
+        self.config = config
+        self.api_key = None
         self.__stop = False
-        self.last_payload = None
+        self.last_payloads = {}
         self.daemon = True
 
     def run(self):
@@ -364,6 +529,9 @@ class Geolocator(threading.Thread):
                     continue
                 # print("something in queue")
                 payload = self.glo_queue.get()
+                import requests
+                if self.api_key is None:
+                    self.api_key = self.config.google_api_key
                 jsonpayload = {"wifiAccessPoints": payload["wifiAccessPoints"], }
                 response = requests.post(url="https://www.googleapis.com/geolocation/v1/geolocate?key=" + self.api_key,
                                          json=jsonpayload)
@@ -375,14 +543,16 @@ class Geolocator(threading.Thread):
                     payload['loc'] = {'lat': location['lat'], 'lon': location['lng']}
                     payload['error.lat'] = error
                     payload['error.lon'] = error
-                    if self.last_payload is None:
+                    last_payload = self.last_payloads.get(payload['meta.devID'])
+                    if last_payload is None:
                         payload['pos.speed'] = 0
                     else:
-                        payload['pos.speed'] = geohash.haversine(location['lat'], location['lng'], self.last_payload['loc']['lat'], self.last_payload['loc']['lon']) / (payload['meta.deviceepoch'] - self.last_payload['meta.deviceepoch'])
+                        payload['pos.speed'] = geohash.haversine(location['lat'], location['lng'], last_payload['loc']['lat'], last_payload['loc']['lon']) / (payload['meta.deviceepoch'] - last_payload['meta.deviceepoch'])
                     # print(location['lat'], location['lng'])
-                    self.memory.geocode(payload)
+                    with self.memory.lock:
+                        self.memory.geocode(payload)
                     # print(payload)
-                    self.last_payload = payload
+                    self.last_payloads[payload['meta.devID']] = payload
                 else:
                     response.raise_for_status()
             except:
@@ -398,22 +568,166 @@ class Geolocator(threading.Thread):
 
 
 class Uploader(threading.Thread):
-    def __init__(self, name, upl_queue, aws_auth, log_queue):
+    """
+    Separate thread of control for uploading payloads to Elasticsearch.
+
+    Payloads are written in bulk, up to config.es_bulk_size at a time, into time partitioned indices shared by every
+    device, named <es_index_prefix><YYYY.MM.DD> (or <YYYY.MM> when config.es_partition is "month"), so no single index
+    grows without limit, old days can be dropped or archived as a whole, and the number of shards does not grow with
+    the number of devices. Searches for a device filter on the meta.devID keyword. The Uploader creates every index
+    with the settings and mappings of Uploader.index_body() before it first writes to it, instead of leaving
+    Elasticsearch to create it with dynamic mappings, which would then stay for the life of the index.
+
+    A bulk request that fails to connect or is rejected with 429 (too many requests), and the documents within a bulk
+    request rejected with 429, are sent again after 2, 4, 8, 16 and 30 seconds, before they are given up on and logged.
+    That is safe because every document has a fixed id (see below).
+
+    Payloads with a location also get a pos.geohash field (GEOHASH_PRECISION bits, as a string), which the query module
+    uses to find points near a location with prefix queries. It is taken from the pos.geohash_int the Pi sends, when
+    there is one.
+
+    Summary documents from aggregate.Aggregator go into one <es_index_prefix>summary-<YYYY.MM> index per month. A
+    payload with a meta.id is stored under that id, so a newer summary of the same device and day replaces the old one.
+    Every other payload is stored under <devID>-<meta.deviceepoch in milliseconds> (see document_id()), so uploading a
+    fix again, after a failed bulk request or a redelivered message, overwrites it instead of adding a copy.
+    """
+    DOC_TYPE = "location_data"
+    GEOHASH_PRECISION = 40
+    RETRY_DELAYS = (2, 4, 8, 16, 30)
+
+    def __init__(self, name, upl_queue, config, log_queue):
         threading.Thread.__init__(self, name=name)
         self.__stop = False
-
-        endpoint = "search-chriswillelasticsearch-sbzs5dhk3efss3t4bidlxmym7u.us-east-1.es.amazonaws.com"
-        self.esnode = Elasticsearch(
-            hosts=[{'host': endpoint, 'port': 443}],
-            http_auth=aws_auth,
-            use_ssl=True,
-            verify_certs=True,
-            connection_class=RequestsHttpConnection
-        )
+        self.config = config
+        self._esnode = None
+        # the indices this Uploader has created, or found already there
+        self.created = set()
         self.upl_queue = upl_queue
         self.log_queue = log_queue
         self.daemon = True
 
+    @property
+    def esnode(self):
+        """
+        Elasticsearch client, created on the first upload rather than when the Uploader is built
+        """
+        if self._esnode is None:
+            self._esnode = self.config.elasticsearch()
+        return self._esnode
+
+    def create_indices(self, names):
+        """
+        Creates each of the indices that has not been created (or found to exist) before, with index_body()
+
+        :param names: names of the indices a batch is about to be written to
+        :return: None
+        :raises elasticsearch.TransportError: if an index could not be created, in which case the batch must not be sent
+        """
+        from elasticsearch import RequestError
+        for name in names - self.created:
+            try:
+                self.esnode.indices.create(index=name, body=self.index_body())
+            except RequestError as error:
+                if error.error != "resource_already_exists_exception":
+                    raise
+            self.created.add(name)
+
+    def index_body(self) -> dict:
+        """
+        Settings and mappings of the location and summary indices.
+
+        loc is a geo_point, the meta fields used for filtering are keywords and doubles, and the error.* fields are kept
+        (in _source and doc values) but not indexed, since nothing searches on them. geo.* fields added by the Geocoder
+        are mapped as keywords. The stats.* fields are those of the daily summaries; the ones that are only there so a
+        summary can be resumed from are not indexed. wifiAccessPoints is neither indexed nor kept in _source.
+
+        :return: the body of an indices.create request, for Elasticsearch 6
+        """
+        def fields(field_type, names, **options):
+            return {name: dict(type=field_type, **options) for name in names}
+
+        return {
+            "settings": {
+                "number_of_shards": self.config.es_shards,
+                "refresh_interval": self.config.es_refresh_interval
+            },
+            "mappings": {
+                self.DOC_TYPE: {
+                    "_source": {"excludes": ["wifiAccessPoints"]},
+                    "dynamic_templates": [
+                        {"geo_strings": {"path_match": "geo.*", "mapping": {"type": "keyword"}}}
+                    ],
+                    "properties": {
+                        "loc": {"type": "geo_point"},
+                        "meta": {"properties": dict(
+                            fields("keyword", ["devID", "type", "dwell", "id"]),
+                            suppressed={"type": "integer"},
+                            **fields("double", ["deviceepoch", "messageepoch"]),
+                            weight={"type": "float"})},
+                        "error": {"properties": fields("float", ["climb", "speed", "altitude", "lat", "lon"],
+                                                       index=False)},
+                        "pos": {"properties": dict(fields("float", ["alt", "climb", "track", "speed"]),
+                                                   geohash={"type": "keyword"},
+                                                   geohash_int={"type": "long", "index": False})},
+                        "road": {"properties": {"id": {"type": "keyword"}, "loc": {"type": "geo_point"},
+                                                "distance": {"type": "float"}}},
+                        "time": {"properties": dict(
+                            fields("byte", ["month", "day", "hour", "minute", "second"]),
+                            year={"type": "short"},
+                            timezone={"type": "keyword", "index": False})},
+                        "stats": {"properties": dict(
+                            fields("integer", ["fixes", "dwells"]),
+                            **fields("float", ["distance", "moving_seconds", "dwell_seconds", "speed_p50",
+                                               "speed_p90", "speed_p99", "speed_max"]),
+                            **fields("double", ["last_lat", "last_lon"], index=False),
+                            speed_counts={"type": "integer", "index": False},
+                            first_epoch={"type": "double"},
+                            places={"properties": {"geohash": {"type": "keyword"}, "dwells": {"type": "integer"}}})},
+                        "wifiAccessPoints": {"type": "object", "enabled": False}
+                    }
+                }
+            }
+        }
+
+    def index_name(self, payload: dict) -> str:
+        """
+        :param payload: payload to be uploaded
+        :return: the name of the time partitioned index the payload belongs in, based on its time.* fields, or on
+        meta.deviceepoch if those are missing
+        """
+        if "time.year" in payload:
+            year, month, day = payload["time.year"], payload["time.month"], payload["time.day"]
+        else:
+            date = time.gmtime(payload["meta.deviceepoch"])
+            year, month, day = date.tm_year, date.tm_mon, date.tm_mday
+        if payload["meta.type"] == "summary":
+            return self.config.es_index_prefix + "summary-%04d.%02d" % (year, month)
+        if self.config.es_partition == "month":
+            return self.config.es_index_prefix + "%04d.%02d" % (year, month)
+        return self.config.es_index_prefix + "%04d.%02d.%02d" % (year, month, day)
+
+    def stored(self, payload: dict):
+        """
+        :param payload: a payload with a meta.id, or at least its meta.* and time.* fields (see aggregate.TrackStats.key())
+        :return: the document stored under the same index and id, or None if there is none
+        :raises elasticsearch.TransportError: if Elasticsearch cannot be reached
+        """
+        found = self.esnode.get(index=self.index_name(payload), doc_type=self.DOC_TYPE, id=self.document_id(payload),
+                                ignore=404)
+        if not found.get("found"):
+            return None
+        return found["_source"]
+
+    @staticmethod
+    def document_id(payload: dict) -> str:
+        """
+        :return: the Elasticsearch _id of a payload: its meta.id if it has one, otherwise one made from its device and
+        time, which are the same every time the same fix is uploaded
+        """
+        if "meta.id" in payload:
+            return payload["meta.id"]
+        return "%s-%d" % (payload["meta.devID"], round(payload["meta.deviceepoch"] * 1000))
+
     def run(self):
         while 1:
             try:
@@ -423,17 +737,62 @@ class Uploader(threading.Thread):
                     time.sleep(1)
                     continue
 
-                payload = self.upl_queue.get()
-                if payload["meta.type"] == "geocode":
-                    self.upload_location(payload)
-                    self.log_queue.put(("Uploader", "sent geocoded payload\n"))
-                else:
-                    self.upload_location(payload)
+                batch = [self.upl_queue.get()]
+                while len(batch) < self.config.es_bulk_size:
+                    try:
+                        batch.append(self.upl_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self.upload_batch(batch)
             except:
                 self.log_queue.put(("Uploader", "Error: " + str(sys.exc_info()) + "\n"))
 
-    def upload_location(self, payload):
-        self.esnode.index(index=payload["meta.devID"], doc_type="location_data", body=payload)
+    def upload_batch(self, payloads):
+        """
+        Sends a list of payloads to Elasticsearch in a single bulk request, once the indices it writes to exist (see
+        create_indices()), retrying the request or the documents in it that failed for a reason that can pass (see
+        RETRY_DELAYS), and logs any documents that still failed
+
+        :param payloads: payloads taken from the upload queue
+        :return: None
+        """
+        from elasticsearch import helpers, TransportError
+        for payload in payloads:
+            if "pos.geohash_int" in payload:
+                payload["pos.geohash"] = geohash.int_to_geohash(payload["pos.geohash_int"], self.GEOHASH_PRECISION)
+            elif "loc" in payload and "pos.geohash" not in payload:
+                payload["pos.geohash"] = geohash.geohash(payload["loc"]["lat"], payload["loc"]["lon"],
+                                                         self.GEOHASH_PRECISION)[0]
+        actions = [{"_index": self.index_name(payload), "_type": self.DOC_TYPE, "_id": self.document_id(payload),
+                    "_source": payload} for payload in payloads]
+        geocoded = sum(1 for payload in payloads if payload["meta.type"] == "geocode")
+        for delay in self.RETRY_DELAYS + (None,):
+            try:
+                self.create_indices({action["_index"] for action in actions})
+                uploaded, errors = helpers.bulk(self.esnode, actions, raise_on_error=False)
+            except TransportError as error:
+                # ConnectionError is a TransportError whose status_code is "N/A"
+                if error.status_code not in ("N/A", 429) or delay is None:
+                    raise
+                self.log_queue.put(("Uploader", "bulk request failed, retrying in " + str(delay) + "s: " + str(error) +
+                                    "\n"))
+                time.sleep(delay)
+                continue
+            retry = set()
+            for error in errors:
+                item = next(iter(error.values()))
+                if item.get("status") == 429 and delay is not None:
+                    retry.add(item.get("_id"))
+                else:
+                    self.log_queue.put(("Uploader", "Error: bulk item failed: " + str(error) + "\n"))
+            if not retry:
+                break
+            actions = [action for action in actions if action["_id"] in retry]
+            self.log_queue.put(("Uploader", str(len(actions)) + " documents rejected, retrying in " + str(delay) +
+                                "s\n"))
+            time.sleep(delay)
+        if geocoded:
+            self.log_queue.put(("Uploader", "sent " + str(geocoded) + " geocoded payloads\n"))
 
     def stop_thread(self):
         """
@@ -450,20 +809,29 @@ class Log(threading.Thread):
     Each payload in the queue should be a tuple where index 0 is the name of the thread the message is from and index 1
     is the message to be logged
     """
-    def __init__(self, log_queue):
+    def __init__(self, log_queue, path):
         threading.Thread.__init__(self, name="Logging")
-        self.log = open("/home/ubuntu/FILES/mqtt-es/mqtt-es.log", "a")
+        self.path = path
+        self.log = None
         self.log_queue = log_queue
         self.__stop = False
         self.daemon = True
 
     def run(self):
+        try:
+            self.log = open(self.path, "a")
+        except OSError as error:
+            # keep draining the queue, so that nothing waiting on it blocks forever
+            print("Logging: cannot open " + self.path + " (" + str(error) + "), logging to stderr", file=sys.stderr)
+            self.log = sys.stderr
         while 1:
             try:
                 if self.__stop:
+                    self.log.flush()
                     return 0
                 if self.log_queue.empty():
                     time.sleep(0.1)
+                    continue
 
                 payload = self.log_queue.get()
                 self.log.write(str(time.time()) + " - " + payload[0] + ":   " + payload[1] + '\n')
@@ -1,54 +1,92 @@
 #!/usr/bin/python3
-from requests_aws4auth import AWS4Auth
 import paho.mqtt.client as mqtt
 import time
-import memory
+import memory, profiling
+from config import Config
+from gpscommon import topics
 
 
-def main():
-    keys = open("/home/ubuntu/keys/api-keys.txt", 'r')
-    usrfile = open("/home/ubuntu/keys/usrfile.pswd")
-    aws_key = keys.readline().replace('\n', '')
-    aws_secret = keys.readline().replace('\n', '')
-    google_api_key = keys.readline().replace('\n', '')
-    usrnm = usrfile.readline().replace('\n', '')
-    passwd = usrfile.readline().replace('\n', '')
-    usrfile.close()
-    keys.close()
+def device_topics(config):
+    """
+    :return: the topics a single consumer listens on: the plain mqtt_topic, and every per-device topic
+    (<mqtt_topic>/<bucket>/<devID>, see gpscommon.topics)
+    """
+    return [config.mqtt_topic] + topics.worker_topics(config.mqtt_topic, 0, 1)
 
-    region = "us-east-1"
-    service = "es"
-    aws_auth = AWS4Auth(aws_key, aws_secret, region, service)
 
-    mem = memory.Memory(google_api_key, aws_auth)
-    try:
-        def on_connect(client, userdata, flags, rc):
-            print(str(userdata))
-            client.subscribe("gpsd_location")
-            print("Connected with result code: " + str(rc))
+def connect(config, mem, client_id, topics, accept=None, counters=None):
+    """
+    Builds an mqtt client that feeds every message on the given topics into mem, and connects it to the broker.
+
+    :param config: the server Config
+    :param mem: the memory.Memory that received payloads are passed to
+    :param client_id: mqtt client id. Sessions are kept between connections, so this should be stable per consumer
+    :param topics: list of topics to subscribe to
+    :param accept: optional function taking a topic and returning False for messages this consumer should not handle
+    (such as a worker's heartbeat echoes). Those are not counted
+    :param counters: optional dict with 'received', 'duplicates', 'processed' and 'errors' counts to update
+    :return: the connected client. The caller is responsible for running its network loop, and for calling
+    mem.tick() about once a second
+    """
+    usrnm, passwd = config.mqtt_credentials()
+    if counters is None:
+        counters = {'received': 0, 'duplicates': 0, 'processed': 0, 'errors': 0}
 
-        def on_message(client, userdata, msg):
-            messagetime = time.time()
+    def on_connect(client, userdata, flags, rc):
+        print(str(userdata))
+        for topic in topics:
+            client.subscribe(topic)
+        print("Connected with result code: " + str(rc))
+
+    def on_message(client, userdata, msg):
+        messagetime = time.time()
+        if accept is not None and not accept(msg.topic):
+            return
+        counters['received'] += 1
+        try:
             payload = mem.verify(msg.payload)
             if 'error' not in payload:
                 # print(payload['meta.deviceepoch'], payload['meta.type'])
-                if payload["meta.type"] == "wifilocation":
-                    payload["meta.messageepoch"] = messagetime
-                    # print("geolocating")
-                    mem.geolocate(payload)
-                else:
-                    # print("geocoding")
-                    payload["meta.messageepoch"] = messagetime
-                    mem.geocode(payload)
-
-        client = mqtt.Client('ec2instance', clean_session=False, userdata='ec2instance')
-        client.username_pw_set(usrnm, passwd)
-        client.on_connect = on_connect
-        client.on_message = on_message
-        client.connect('127.0.0.1', 1883, 60)
-
-        client.loop_forever()
+                payload["meta.messageepoch"] = messagetime
+                if not mem.receive(payload):
+                    counters['duplicates'] += 1
+                    return
+            counters['processed'] += 1
+        except Exception as e:
+            counters['errors'] += 1
+            mem.log_queue.put((client_id, "Error handling message on " + msg.topic + ": " + repr(e)))
+
+    client = mqtt.Client(client_id, clean_session=False, userdata=client_id)
+    client.username_pw_set(usrnm, passwd)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(config.mqtt_host, config.mqtt_port, config.mqtt_keepalive)
+    return client
+
+
+def main(config=None):
+    if config is None:
+        config = Config.load()
+    config.check()
+    if config.workers > 1:
+        import supervisor
+        supervisor.Supervisor(config).run()
+        return
+
+    mem = memory.Memory(config)
+    profiling.install(config, mem.log_queue)
+    client = None
+    try:
+        client = connect(config, mem, config.mqtt_client_id, device_topics(config))
+        client.loop_start()
+        while True:
+            time.sleep(1)
+            mem.tick()
     finally:
+        # stop taking messages before the threads that process them
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
         mem.stop_threads()
 
 
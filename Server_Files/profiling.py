@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+import os, signal, sys, threading, time
+
+"""Profiling the running server.
+
+Two tools, both off unless configured:
+
+StageTimers measures the wall clock and CPU time of each call to the main stages of the pipeline (Memory.verify,
+Memory.geocode, Memory.searchelseinsert and the Uploader's uploads), by wrapping them. Each call costs about a
+microsecond more, so they can stay on in production; Memory logs the totals every config.stats_interval seconds.
+
+StackSampler takes a snapshot of the stack of every thread `rate` times a second for a few seconds, and writes the
+counts in the collapsed stack format ("thread;outer function;...;inner function count" per line) that flamegraph.pl
+and speedscope read. With config.profile_dir set, sending the process SIGUSR1 starts one:
+
+    kill -USR1 <pid>
+    flamegraph.pl /tmp/profiles/profile-<pid>-<time>.collapsed > profile.svg
+"""
+
+
+class StageTimers:
+    """
+    Call counts and wall clock and CPU time per stage, since the last report
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def wrap(self, stage, function):
+        """
+        :param stage: name the calls are counted under
+        :param function: the function to time
+        :return: a function that calls `function` and adds the time it took to the stage
+        """
+        perf_counter, thread_time = time.perf_counter, time.thread_time
+
+        def timed(*args, **kwargs):
+            wall, cpu = perf_counter(), thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, perf_counter() - wall, thread_time() - cpu)
+        return timed
+
+    def add(self, stage, wall, cpu):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0.0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            if wall > totals[3]:
+                totals[3] = wall
+
+    def report(self) -> str:
+        """
+        :return: one line with the calls, total and mean wall time, mean CPU time and longest call of each stage since
+        the last report, and resets them
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        parts = []
+        for stage, (calls, wall, cpu, longest) in sorted(stages.items()):
+            parts.append("%s: calls=%d wall=%.3fs mean=%.1fus cpu=%.1fus max=%.1fms" %
+                         (stage, calls, wall, wall / calls * 1e6, cpu / calls * 1e6, longest * 1e3))
+        return "; ".join(parts)
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of every other thread for `duration` seconds, then writes them to `path` in collapsed stack
+    format
+    """
+    def __init__(self, path, duration=30, rate=100):
+        """
+        :param path: file to write
+        :param duration: how long to sample for, in seconds
+        :param rate: samples per second
+        """
+        threading.Thread.__init__(self, name="StackSampler")
+        self.path = path
+        self.duration = duration
+        self.interval = 1 / rate
+        self.counts = {}
+        self.daemon = True
+
+    def run(self):
+        own = threading.get_ident()
+        end = time.time() + self.duration
+        while time.time() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s)" % (code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            time.sleep(self.interval)
+        with open(self.path, "w") as file:
+            for stack, count in sorted(self.counts.items()):
+                file.write("%s %d\n" % (stack, count))
+
+
+def install(config, log_queue):
+    """
+    Makes SIGUSR1 start a StackSampler writing to config.profile_dir, if that is set. Has to be called from the main
+    thread. A signal that arrives while a sampler is still running is ignored.
+
+    :param config: the server Config
+    :param log_queue: queue to log the start of each profile to
+    :return: None
+    """
+    if not config.profile_dir or not hasattr(signal, "SIGUSR1"):
+        return
+    running = []
+
+    def start(signum, frame):
+        if running and running[0].is_alive():
+            return
+        os.makedirs(config.profile_dir, exist_ok=True)
+        path = os.path.join(config.profile_dir, "profile-%d-%d.collapsed" % (os.getpid(), time.time()))
+        sampler = StackSampler(path, config.profile_seconds, config.profile_rate)
+        running[:] = [sampler]
+        sampler.start()
+        log_queue.put(("Profiler", "sampling every thread for " + str(config.profile_seconds) + "s into " + path))
+
+    signal.signal(signal.SIGUSR1, start)
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+import time
+from gpscommon import geohash
+from memory import Uploader
+
+"""Queries over the stored location history.
+
+Every query is turned into a set of geohash prefixes (see geohash.cover()) and a time range, which a source can answer
+cheaply, and the candidates it returns are then filtered exactly with geohash.haversines(). Results are generators, so
+a query over a long period never has to hold all of its points in memory.
+
+A source is any object with a search() method like ElasticsearchSource.search(): it takes optional prefixes, start,
+end, devices and types, and yields payloads in the same form the Uploader stores them.
+
+Examples:
+    source = ElasticsearchSource(Config.load())
+    for dev_id in devices_within(source, 39.1854, -76.8508, 200, start, end):
+        ...
+    for payload in track(source, 'gpsd_cgood', start, end):
+        ...
+"""
+
+
+class ElasticsearchSource:
+    """
+    Reads payloads back out of the time partitioned indices written by memory.Uploader
+    """
+    def __init__(self, config, esnode=None, page_size=1000):
+        """
+        :param config: the server Config
+        :param esnode: optional Elasticsearch client. One is built from the config on first use otherwise
+        :param page_size: number of documents fetched per scroll request
+        """
+        self.config = config
+        self._esnode = esnode
+        self.page_size = page_size
+
+    @property
+    def esnode(self):
+        if self._esnode is None:
+            self._esnode = self.config.elasticsearch()
+        return self._esnode
+
+    def indices(self, start=None, end=None) -> str:
+        """
+        Works out which indices a search has to look at. A time range of up to 62 partitions is narrowed to those
+        partitions; otherwise every location index is searched, leaving out the summaries. Devices are not narrowed
+        down here, since every device shares the same indices, but by the meta.devID filter in search().
+
+        :return: comma separated index names and patterns
+        """
+        base = self.config.es_index_prefix
+        every = base + '*,-' + base + 'summary-*'
+        if start is None or end is None:
+            return every
+        monthly = self.config.es_partition == 'month'
+        partitions = []
+        day = start - start % 86400
+        while day <= end and len(partitions) <= 62:
+            date = time.gmtime(day)
+            if monthly:
+                partition = '%04d.%02d' % (date.tm_year, date.tm_mon)
+            else:
+                partition = '%04d.%02d.%02d' % (date.tm_year, date.tm_mon, date.tm_mday)
+            if partition not in partitions:
+                partitions.append(partition)
+            day += 86400
+        if len(partitions) > 62:
+            return every
+        return ','.join(base + partition for partition in partitions)
+
+    def search(self, prefixes=None, start=None, end=None, devices=None, types=None, ordered=False):
+        """
+        Streams the payloads matching every filter given, using the scroll API
+
+        :param prefixes: optional list of geohash prefixes, matched against pos.geohash
+        :param start: optional earliest meta.deviceepoch
+        :param end: optional latest meta.deviceepoch
+        :param devices: optional list of meta.devID values
+        :param types: optional list of meta.type values
+        :param ordered: if True, payloads come back in meta.deviceepoch order, which is slower
+        :return: generator of payloads
+        """
+        from elasticsearch import helpers
+        filters = []
+        if prefixes:
+            filters.append({"bool": {"should": [{"prefix": {"pos.geohash": prefix}} for prefix in prefixes],
+                                     "minimum_should_match": 1}})
+        if start is not None or end is not None:
+            epoch_range = {}
+            if start is not None:
+                epoch_range["gte"] = start
+            if end is not None:
+                epoch_range["lte"] = end
+            filters.append({"range": {"meta.deviceepoch": epoch_range}})
+        if devices:
+            filters.append({"terms": {"meta.devID": list(devices)}})
+        if types:
+            filters.append({"terms": {"meta.type": list(types)}})
+        body = {"query": {"bool": {"filter": filters}}}
+        if ordered:
+            body["sort"] = [{"meta.deviceepoch": "asc"}]
+        for hit in helpers.scan(self.esnode, query=body, index=self.indices(start, end),
+                                preserve_order=ordered, size=self.page_size, ignore_unavailable=True):
+            yield hit["_source"]
+
+
+def refine(payloads, lat, lon, radius):
+    """
+    Keeps the payloads that are really within radius meters of (lat, lon), and adds that distance to each of them
+    as "distance"
+
+    :param payloads: list of payloads with a loc field
+    :return: generator of the payloads inside the circle
+    """
+    distances = geohash.haversines(lat, lon, [payload["loc"]["lat"] for payload in payloads],
+                                   [payload["loc"]["lon"] for payload in payloads])
+    for payload, distance in zip(payloads, distances):
+        if distance <= radius:
+            payload["distance"] = distance
+            yield payload
+
+
+def within(source, lat, lon, radius, start=None, end=None, devices=None, chunk=1000):
+    """
+    Finds every stored location within radius meters of a point, between two times.
+
+    :param source: where to search, e.g. an ElasticsearchSource
+    :param lat: latitude of the point, in decimal degrees
+    :param lon: longitude of the point, in decimal degrees
+    :param radius: in meters
+    :param start: optional earliest meta.deviceepoch
+    :param end: optional latest meta.deviceepoch
+    :param devices: optional list of devices to limit the search to
+    :param chunk: number of candidates filtered at a time
+    :return: generator of payloads, each with its "distance" from the point
+    """
+    prefixes = geohash.cover(lat, lon, radius, max_precision=Uploader.GEOHASH_PRECISION)
+    batch = []
+    for payload in source.search(prefixes, start, end, devices):
+        if "loc" not in payload:
+            continue
+        batch.append(payload)
+        if len(batch) >= chunk:
+            yield from refine(batch, lat, lon, radius)
+            batch = []
+    yield from refine(batch, lat, lon, radius)
+
+
+def devices_within(source, lat, lon, radius, start=None, end=None):
+    """
+    Answers "which devices were within radius meters of this point between start and end"
+
+    :return: generator of device ids, each given once, as soon as its first matching location is found
+    """
+    seen = set()
+    for payload in within(source, lat, lon, radius, start, end):
+        if payload["meta.devID"] not in seen:
+            seen.add(payload["meta.devID"])
+            yield payload["meta.devID"]
+
+
+def track(source, dev_id, start=None, end=None):
+    """
+    :param source: where to search
+    :param dev_id: the device to get the track of
+    :param start: optional earliest meta.deviceepoch
+    :param end: optional latest meta.deviceepoch
+    :return: generator of the device's stored locations, in time order
+    """
+    return source.search(start=start, end=end, devices=[dev_id], ordered=True)
+
+
+def dwells(source, dev_id, start=None, end=None):
+    """
+    The places a device has stayed at are the payloads that Memory sent to be geocoded, i.e. those of type "geocode"
+
+    :param source: where to search
+    :param dev_id: the device to get the dwell places of
+    :param start: optional earliest meta.deviceepoch
+    :param end: optional latest meta.deviceepoch
+    :return: generator of geocoded payloads, in time order
+    """
+    return source.search(start=start, end=end, devices=[dev_id], types=["geocode"], ordered=True)
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+import multiprocessing, os, queue, signal, time
+from config import Config
+from gpscommon import topics
+
+# cpu is the CPU time the worker has used, in seconds
+COUNTERS = ('received', 'duplicates', 'processed', 'errors', 'cpu')
+
+
+def run_worker(index, workers, config, stats_queue):
+    """
+    Entry point of a worker process. Each worker runs its own Memory and mqtt client, subscribed only to the per-device
+    topics of the buckets it owns (see gpscommon.topics.worker_topics()), so the broker sends it just the messages of
+    its own devices, and every device's dwell state stays in a single process. Worker 0 also subscribes to the plain
+    mqtt_topic, so devices that have not moved to per-device topics are still handled, by one worker.
+
+    Every stats_interval seconds the worker publishes an empty message to its own heartbeat topic
+    (<mqtt_topic>-heartbeat/<client id>), and puts (index, pid, time, counters) on stats_queue, where time is when the
+    last of those messages came back. The supervisor uses that as the heartbeat, so a worker whose connection to the
+    broker or mqtt network thread has died stops looking healthy, and the counters for the aggregated stats.
+
+    :param index: index of this worker
+    :param workers: total number of workers
+    :param config: the server Config
+    :param stats_queue: multiprocessing.Queue shared with the supervisor
+    :return: None
+    """
+    import memory, mqttelasticsearch, profiling
+    config = Config(dict(config.values, log_file=config.log_file + '.' + str(index)))
+    client_id = config.mqtt_client_id + '-' + str(index)
+    heartbeat = config.mqtt_topic + '-heartbeat/' + client_id
+    subscriptions = topics.worker_topics(config.mqtt_topic, index, workers) + [heartbeat]
+    if index == 0:
+        subscriptions.append(config.mqtt_topic)
+    echoed = [0]
+
+    def accept(topic):
+        if topic == heartbeat:
+            echoed[0] = time.time()
+            return False
+        return True
+
+    counters = dict.fromkeys(COUNTERS, 0)
+    mem = memory.Memory(config)
+    profiling.install(config, mem.log_queue)
+    client = mqttelasticsearch.connect(config, mem, client_id, subscriptions, accept, counters)
+    client.loop_start()
+    try:
+        reported = 0
+        while True:
+            if time.time() - reported >= config.stats_interval:
+                reported = time.time()
+                counters['cpu'] = round(time.process_time(), 3)
+                stats_queue.put((index, multiprocessing.current_process().pid, echoed[0], dict(counters)))
+                client.publish(heartbeat, b'')
+            time.sleep(1)
+            mem.tick()
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        mem.stop_threads()
+
+
+class Worker:
+    """
+    Supervisor-side record of one worker process: the process itself, its last heartbeat and counters, and the
+    counters of earlier processes in the same slot that have since been restarted.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.started = 0
+        self.heartbeat = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.retired = dict.fromkeys(COUNTERS, 0)
+        self.restarts = 0
+
+    def totals(self):
+        return {key: self.counters[key] + self.retired[key] for key in COUNTERS}
+
+
+class Supervisor:
+    """
+    Runs config.workers worker processes (see run_worker), restarts any that exit or stop sending heartbeats for more
+    than config.worker_timeout seconds, and prints the combined counters every config.stats_interval seconds.
+
+    SIGUSR1 sent to the supervisor is passed on to every worker, each of which then profiles itself (see
+    profiling.install()). Without config.profile_dir it is ignored, by the workers too, rather than killing them.
+    """
+    def __init__(self, config):
+        if config.workers > topics.BUCKETS:
+            raise ValueError("at most " + str(topics.BUCKETS) + " workers, one per topic bucket")
+        self.config = config
+        self.context = multiprocessing.get_context('spawn')
+        self.stats_queue = self.context.Queue()
+        self.workers = [Worker(index) for index in range(config.workers)]
+
+    def start(self, worker):
+        """
+        Starts (or restarts) the process for a worker slot
+        :param worker: the Worker to start
+        :return: None
+        """
+        for key in COUNTERS:
+            worker.retired[key] += worker.counters[key]
+            worker.counters[key] = 0
+        worker.process = self.context.Process(target=run_worker, name="Worker-" + str(worker.index),
+                                              args=(worker.index, len(self.workers), self.config, self.stats_queue))
+        worker.process.daemon = True
+        worker.process.start()
+        worker.started = worker.heartbeat = time.time()
+
+    def collect(self, timeout):
+        """
+        Reads heartbeats from the stats queue until timeout seconds have passed
+        :param timeout: time to spend collecting, in seconds
+        :return: None
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                index, pid, sent, counters = self.stats_queue.get(timeout=remaining)
+            except queue.Empty:
+                return
+            worker = self.workers[index]
+            if worker.process is not None and worker.process.pid == pid:
+                # 0 until the worker's first heartbeat message has come back, which leaves the start time in place
+                worker.heartbeat = max(worker.heartbeat, sent)
+                worker.counters = counters
+
+    def check(self):
+        """
+        Restarts every worker whose process has exited or has gone quiet for longer than config.worker_timeout
+        :return: None
+        """
+        now = time.time()
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                print("Worker " + str(worker.index) + " exited with code " + str(worker.process.exitcode) + ", restarting")
+            elif now - worker.heartbeat > self.config.worker_timeout:
+                print("Worker " + str(worker.index) + " missed its heartbeat, restarting")
+                worker.process.terminate()
+                worker.process.join(5)
+            else:
+                continue
+            worker.restarts += 1
+            self.start(worker)
+
+    def stats(self) -> dict:
+        """
+        :return: the counters summed over all workers, including processes that have been restarted, plus the number
+        of workers alive and the number of restarts
+        """
+        totals = dict.fromkeys(COUNTERS, 0)
+        for worker in self.workers:
+            for key, value in worker.totals().items():
+                totals[key] += value
+        totals['alive'] = sum(1 for worker in self.workers if worker.process.is_alive())
+        totals['restarts'] = sum(worker.restarts for worker in self.workers)
+        return totals
+
+    def forward(self, signum, frame):
+        """
+        Signal handler that sends the signal on to every worker process that is alive
+        """
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signum)
+
+    def run(self):
+        if hasattr(signal, "SIGUSR1"):
+            # set before the workers start: they inherit an ignored signal, but not a handler
+            signal.signal(signal.SIGUSR1, self.forward if self.config.profile_dir else signal.SIG_IGN)
+        for worker in self.workers:
+            self.start(worker)
+        last = self.stats()
+        last_time = time.time()
+        try:
+            while True:
+                self.collect(self.config.stats_interval)
+                self.check()
+                stats = self.stats()
+                now = time.time()
+                rate = (stats['processed'] - last['processed']) / (now - last_time)
+                print("STATS::: " + ', '.join(key + '=' + str(value) for key, value in stats.items()) +
+                      ', processed/s=' + str(round(rate, 1)))
+                last, last_time = stats, now
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(5)
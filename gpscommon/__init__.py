@@ -0,0 +1,7 @@
+"""
+Code shared by the Raspberry Pi (Pi_Files) and the server (Server_Files).
+
+Both directories contain a "gpscommon" symlink to this package, so scripts in either one can import it as
+"from gpscommon import geohash" without installing anything. When copying Pi_Files or Server_Files to a machine, copy
+the package along with it (scp -r and rsync -L follow the link).
+"""
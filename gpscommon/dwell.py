@@ -0,0 +1,87 @@
+from gpscommon import geohash
+
+# The kinds of fix DwellDetector.classify() tells apart
+STAY = 'stay'    # close to the anchor, slow, and not yet there for dwell_time
+DWELL = 'dwell'  # close to the anchor, for longer than dwell_time: the device is staying somewhere
+MOVE = 'move'    # close to the anchor, but moving fast
+LEAVE = 'leave'  # away from the anchor, moving fast: the device has left the place it was at
+AWAY = 'away'    # away from the anchor, but slow
+
+# Precision of the geohashes used to look places up in the server's memory tree, in bits
+GEOHASH_PRECISION = 35
+
+
+class DwellDetector:
+    """
+    The dwell check that Memory.geocode() runs for each device, kept here so the Pi can run exactly the same check on
+    the fixes it sends.
+
+    The detector keeps an anchor fix. A new fix within radius meters of it (plus the average error of the two) is
+    close; a close fix more than dwell_time seconds after the anchor means the device is dwelling there. The anchor
+    moves to the new fix when the device dwells, moves fast, or leaves; otherwise it stays, so slow drifting is measured
+    from where the device stopped.
+
+    Fixes are dicts with the payload fields loc, meta.deviceepoch, pos.speed, error.lat and error.lon.
+    """
+    def __init__(self, radius=30, dwell_time=180, moving_speed=2):
+        """
+        :param radius: distance from the anchor that still counts as the same place, in meters
+        :param dwell_time: time in the same place that counts as a dwell, in seconds
+        :param moving_speed: speed above which a fix counts as moving
+        """
+        self.radius = radius
+        self.dwell_time = dwell_time
+        self.moving_speed = moving_speed
+        self.anchor = None
+
+    def classify(self, payload) -> str:
+        """
+        Works out what a fix means relative to the anchor, without changing the anchor
+
+        :param payload: the fix
+        :return: one of STAY, DWELL, MOVE, LEAVE or AWAY
+        """
+        anchor = self.anchor if self.anchor is not None else payload
+        avg_error = (payload["error.lat"] + payload["error.lon"] + anchor["error.lat"] + anchor["error.lon"]) / 4
+        if geohash.haversine(payload["loc"]["lat"], payload["loc"]["lon"], anchor["loc"]["lat"], anchor["loc"]["lon"]) < self.radius + avg_error:
+            if abs(payload["meta.deviceepoch"] - anchor["meta.deviceepoch"]) > self.dwell_time:
+                return DWELL
+            if payload["pos.speed"] > self.moving_speed:
+                return MOVE
+            return STAY
+        if payload["pos.speed"] > self.moving_speed:
+            return LEAVE
+        return AWAY
+
+    def advance(self, payload, kind):
+        """
+        Moves the anchor on after a fix of the given kind. Kept apart from classify() so that a kind worked out
+        elsewhere (e.g. sent along by the Pi) keeps the anchor in step without the distance being measured again.
+
+        :param payload: the fix
+        :param kind: what classify() returned for it
+        :return: the previous anchor
+        """
+        previous = self.anchor if self.anchor is not None else payload
+        if self.anchor is None or kind in (DWELL, MOVE, LEAVE):
+            self.anchor = payload
+        return previous
+
+    def update(self, payload) -> str:
+        """
+        classify() and advance() in one step
+        :return: the kind of the fix
+        """
+        kind = self.classify(payload)
+        self.advance(payload, kind)
+        return kind
+
+
+def cell(payload) -> str:
+    """
+    :return: the geohash string used to look a fix up in the memory tree, taken from the 40 bit pos.geohash_int the Pi
+    attaches if it is there, and computed otherwise
+    """
+    if "pos.geohash_int" in payload:
+        return geohash.int_to_geohash(payload["pos.geohash_int"] >> (40 - GEOHASH_PRECISION), GEOHASH_PRECISION)
+    return geohash.geohash(payload["loc"]["lat"], payload["loc"]["lon"], GEOHASH_PRECISION)[0]
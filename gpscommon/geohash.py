@@ -121,6 +121,161 @@ def ungeohash(s, dec_precision=6):
     return lat, lat_error, lon, lon_error
 
 
+def _spread(x):
+    """
+    Spreads the low 32 bits of x out to the even bits of a 64 bit number, so that two of them can be interleaved
+    """
+    x &= 0xFFFFFFFF
+    x = (x | x << 16) & 0x0000FFFF0000FFFF
+    x = (x | x << 8) & 0x00FF00FF00FF00FF
+    x = (x | x << 4) & 0x0F0F0F0F0F0F0F0F
+    x = (x | x << 2) & 0x3333333333333333
+    return (x | x << 1) & 0x5555555555555555
+
+
+def _compact(x):
+    """
+    The inverse of _spread(): collects the even bits of x into a 32 bit number
+    """
+    x &= 0x5555555555555555
+    x = (x | x >> 1) & 0x3333333333333333
+    x = (x | x >> 2) & 0x0F0F0F0F0F0F0F0F
+    x = (x | x >> 4) & 0x00FF00FF00FF00FF
+    x = (x | x >> 8) & 0x0000FFFF0000FFFF
+    return (x | x >> 16) & 0xFFFFFFFF
+
+
+def geohash_int(lat, lon, bin_precision=64):
+    """
+    The same geohash as geohash(), as an integer instead of a base 32 string.
+
+    Rather than bisecting one bit at a time, each coordinate is scaled to an integer of its share of the bits, and the
+    two are interleaved with _spread(), so this costs the same at any precision. Integers of the same precision sort in
+    the same order as their string forms, so they can be stored and range-searched in place of the strings.
+
+    :param lat: latitude, in decimal degrees
+    :param lon: longitude, in decimal degrees
+    :param bin_precision: number of bits, at most 64
+    :return: the geohash, as an int of bin_precision bits
+    """
+    lon_bits = (bin_precision + 1) // 2
+    lat_bits = bin_precision // 2
+    lon_q = min(int((lon + 180) / 360 * (1 << lon_bits)), (1 << lon_bits) - 1)
+    lat_q = min(int((lat + 90) / 180 * (1 << lat_bits)), (1 << lat_bits) - 1)
+    if bin_precision % 2:
+        return _spread(lon_q) | _spread(lat_q) << 1
+    return _spread(lon_q) << 1 | _spread(lat_q)
+
+
+def ungeohash_int(n, bin_precision=64):
+    """
+    Decodes a geohash made by geohash_int() to the centre of its cell
+
+    :param n: the geohash
+    :param bin_precision: the precision it was made with, in bits
+    :return: (lat, lon)
+    """
+    lon_bits = (bin_precision + 1) // 2
+    lat_bits = bin_precision // 2
+    if bin_precision % 2:
+        lon_q, lat_q = _compact(n), _compact(n >> 1)
+    else:
+        lon_q, lat_q = _compact(n >> 1), _compact(n)
+    return (lat_q + 0.5) / (1 << lat_bits) * 180 - 90, (lon_q + 0.5) / (1 << lon_bits) * 360 - 180
+
+
+def int_to_geohash(n, bin_precision):
+    """
+    Converts a geohash made by geohash_int() to the base 32 string geohash() would give for the same precision
+
+    :param n: the geohash
+    :param bin_precision: the precision it was made with, in bits
+    :return: the geohash, as a string
+    """
+    digits = []
+    remainder = bin_precision % 5
+    if remainder:
+        digits.append(CROCKFORDBASE32_alpha[n & ((1 << remainder) - 1)])
+        n >>= remainder
+    for _ in range(bin_precision // 5):
+        digits.append(CROCKFORDBASE32_alpha[n & 31])
+        n >>= 5
+    return ''.join(reversed(digits))
+
+
+def prefix_range(prefix, bin_precision=64):
+    """
+    Converts a geohash string prefix to the range of geohash_int() values (of the given precision) that start with it
+
+    :param prefix: geohash prefix, in base 32
+    :param bin_precision: precision of the integer geohashes, at least 5 bits per digit of the prefix
+    :return: (low, high), where matching geohashes are low <= n < high
+    """
+    value = 0
+    for digit in prefix:
+        value = value << 5 | CROCKFORDBASE32_alpha.index(digit)
+    shift = bin_precision - 5 * len(prefix)
+    return value << shift, (value + 1) << shift
+
+
+def cells(min_lat, min_lon, max_lat, max_lon, bin_precision):
+    """
+    Lists the geohashes of every cell of the given precision that overlaps a bounding box.
+
+    A geohash with bin_precision bits has bin_precision // 2 latitude bits and (bin_precision + 1) // 2 longitude bits,
+    so every cell is the same size: 180 / 2^lat_bits degrees tall and 360 / 2^lon_bits degrees wide. The cells that
+    overlap the box are found by stepping over that grid, and each one is hashed at its centre.
+
+    :param min_lat: southern edge of the box
+    :param min_lon: western edge of the box
+    :param max_lat: northern edge of the box
+    :param max_lon: eastern edge of the box
+    :param bin_precision: precision of the cells, in bits
+    :return: list of geohashes
+    """
+    height = 180 / 2**(bin_precision // 2)
+    width = 360 / 2**((bin_precision + 1) // 2)
+    min_lat, max_lat = max(min_lat, -90), min(max_lat, 90 - height / 2)
+    result = []
+    row = math.floor((min_lat + 90) / height)
+    while row * height - 90 <= max_lat:
+        col = math.floor((min_lon + 180) / width)
+        while col * width - 180 <= max_lon:
+            lon = (col + 0.5) * width - 180
+            lon = (lon + 180) % 360 - 180
+            result.append(geohash((row + 0.5) * height - 90, lon, bin_precision)[0])
+            col += 1
+        row += 1
+    return result
+
+
+def cover(lat, lon, radius, max_cells=16, max_precision=40):
+    """
+    Finds a small set of geohash prefixes that together contain every point within radius meters of (lat, lon).
+
+    The finest precision (a whole number of base 32 digits) whose cover of the circle's bounding box needs no more than
+    max_cells cells is used, so the prefixes can be matched against stored geohash strings directly. Points inside the
+    cover but outside the circle still have to be filtered out, e.g. with haversine().
+
+    :param lat: latitude of the centre, in decimal degrees
+    :param lon: longitude of the centre, in decimal degrees
+    :param radius: radius of the circle, in meters
+    :param max_cells: most prefixes to return
+    :param max_precision: finest precision to use, in bits. Should not be more than the precision of the stored hashes
+    :return: list of geohash prefixes
+    """
+    dlat = math.degrees(radius / R(math.radians(lat)))
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    box = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+    best = ['']
+    for bits in range(5, max_precision + 1, 5):
+        found = cells(*box, bits)
+        if len(found) > max_cells:
+            break
+        best = found
+    return best
+
+
 def haversine(lat1, lon1, lat2, lon2):
     """
     The Haversine formula calculates the distance between two points over a sphere.
@@ -151,6 +306,29 @@ def haversine(lat1, lon1, lat2, lon2):
     return 2 * R((lat1 + lat2) / 2) * math.asin(math.sqrt(math.sin((lat2 - lat1) / 2)**2 + (math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2)))
 
 
+def haversines(lat, lon, lats, lons):
+    """
+    haversine() from one point to many, for filtering batches of points. The earth's radius is taken once at the
+    reference latitude, and the trigonometry for the reference point is only done once.
+
+    :param lat: reference latitude, in decimal degrees
+    :param lon: reference longitude, in decimal degrees
+    :param lats: sequence of latitudes, in decimal degrees
+    :param lons: sequence of longitudes, in decimal degrees, the same length as lats
+    :return: list of distances from the reference point, in meters
+    """
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    lat1 = radians(lat)
+    lon1 = radians(lon)
+    cos_lat1 = cos(lat1)
+    diameter = 2 * R(lat1)
+    result = []
+    for lat2, lon2 in zip(lats, lons):
+        lat2 = radians(lat2)
+        result.append(diameter * asin(sqrt(sin((lat2 - lat1) / 2)**2 + cos_lat1 * cos(lat2) * sin((radians(lon2) - lon1) / 2)**2)))
+    return result
+
+
 def R(lat):
     """
     Calculates the radius of the earth at a given latitude, in meters
@@ -0,0 +1,89 @@
+import math
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Distance between two nearby points, in meters, using the flat-earth approximation. It is accurate to well under a
+    meter over the few hundred meters the sampler compares, and much cheaper than the haversine formula on the Pi.
+    """
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.sqrt(x * x + y * y)
+
+
+class AdaptiveSampler:
+    """
+    Decides which GPS fixes are worth publishing.
+
+    While the device is moving (faster than moving_speed), every fix is sent. Once it stops, fixes are only sent every
+    `interval` seconds, and the interval doubles after each one, up to max_interval. A fix is still sent straight away
+    if the device has moved more than `displacement` meters (plus the fix's error) from the last fix sent, or, when it
+    is moving slowly, if its heading has changed by more than heading_change degrees.
+
+    The server's Memory.geocode() adds weight for every fix a device stays in place, so the number of fixes skipped
+    since the last one sent is reported with each fix (as meta.suppressed) to keep the weights the same.
+    """
+    def __init__(self, moving_speed=2, min_interval=1, max_interval=60, displacement=30, heading_change=30,
+                 heading_speed=0.5):
+        """
+        :param moving_speed: speed above which every fix is sent. Same units and threshold as the server's check
+        :param min_interval: interval between fixes while moving, in seconds
+        :param max_interval: longest interval between fixes while stationary, in seconds. Should stay well under the
+        3 minutes the server waits before counting a stay as a dwell
+        :param displacement: distance from the last fix sent that forces a fix to be sent, in meters
+        :param heading_change: change of heading that forces a fix to be sent, in degrees
+        :param heading_speed: speed below which the heading is too noisy to use
+        """
+        self.moving_speed = moving_speed
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.displacement = displacement
+        self.heading_change = heading_change
+        self.heading_speed = heading_speed
+        self.interval = min_interval
+        self.last = None
+        self.pending = 0
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_send(self, lat, lon, speed, track, error, now) -> bool:
+        """
+        :param lat: latitude of the fix
+        :param lon: longitude of the fix
+        :param speed: horizontal speed of the fix
+        :param track: heading of the fix, in degrees
+        :param error: horizontal error of the fix, in meters
+        :param now: time of the fix, in seconds
+        :return: True if the fix should be published. If it returns True, the caller must publish the fix, with
+        meta.suppressed set to the value taken from take_suppressed()
+        """
+        if self.last is None:
+            return self.send(lat, lon, track, now, self.min_interval)
+        last_lat, last_lon, last_track, last_time = self.last
+
+        if speed > self.moving_speed:
+            return self.send(lat, lon, track, now, self.min_interval)
+        if distance(lat, lon, last_lat, last_lon) > self.displacement + error:
+            return self.send(lat, lon, track, now, self.min_interval)
+        if speed > self.heading_speed and abs((track - last_track + 180) % 360 - 180) > self.heading_change:
+            return self.send(lat, lon, track, now, self.min_interval)
+        if now - last_time >= self.interval:
+            return self.send(lat, lon, track, now, min(self.interval * 2, self.max_interval))
+
+        self.pending += 1
+        self.suppressed += 1
+        return False
+
+    def send(self, lat, lon, track, now, next_interval) -> bool:
+        self.last = (lat, lon, track, now)
+        self.interval = next_interval
+        self.sent += 1
+        return True
+
+    def take_suppressed(self) -> int:
+        """
+        :return: the number of fixes skipped since the last one sent, and resets it
+        """
+        pending = self.pending
+        self.pending = 0
+        return pending
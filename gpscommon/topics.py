@@ -0,0 +1,33 @@
+import zlib
+
+# Number of buckets the per-device topics are spread over. Changing it moves devices between buckets, so the Pi, the
+# load generator and the server all have to use the same value
+BUCKETS = 64
+
+
+def bucket(dev_id) -> int:
+    """
+    :return: the bucket of a device. crc32 is used instead of hash(), since string hashes are randomised per process
+    and every publisher and worker has to agree on the answer
+    """
+    return zlib.crc32(dev_id.encode('utf-8')) % BUCKETS
+
+
+def device_topic(topic, dev_id) -> str:
+    """
+    :return: the topic a device publishes to, <topic>/<bucket>/<devID>
+    """
+    return "%s/%d/%s" % (topic, bucket(dev_id), dev_id)
+
+
+def worker_topics(topic, index, workers) -> list:
+    """
+    Splits the buckets between workers. Every bucket goes to exactly one worker, so a worker subscribed to its topics
+    only gets the messages of the devices it owns, and the broker sends each message to one worker.
+
+    :param topic: the base topic, e.g. gpsd_location
+    :param index: index of the worker
+    :param workers: number of workers, at most BUCKETS
+    :return: list of wildcard topics, <topic>/<bucket>/+ for every bucket the worker owns
+    """
+    return ["%s/%d/+" % (topic, number) for number in range(index, BUCKETS, workers)]